@@ -16,7 +16,7 @@ import json
 import logging
 import functools
 
-from transwarp.web import ctx
+from transwarp.web import ctx, _HttpError
 
 class Page(object):
     '''
@@ -56,6 +56,32 @@ def _dump(obj):
         }
     raise TypeError('%s is not JSON serializable' % obj)
 
+def _make_encoder(backend):
+    """
+    创建可重复使用的JSONEncoder，使用紧凑的分隔符
+    Model、Dict 都是dict的子类，由C实现的编码器直接处理，Page 由 _dump 转换
+    :param backend: json 或者兼容的模块，比如 simplejson
+    :return: 序列化函数
+    """
+    return backend.JSONEncoder(default=_dump, separators=(',', ':')).encode
+
+try:
+    # simplejson 的C扩展比python2.7 自带的json 更快，安装了就使用
+    import simplejson
+    from simplejson import _speedups
+    _encode = _make_encoder(simplejson)
+except ImportError:
+    _encode = _make_encoder(json)
+
+def set_json_backend(backend):
+    """
+    替换序列化使用的json模块
+    :param backend: json 或者兼容的模块
+    :return:
+    """
+    global _encode
+    _encode = _make_encoder(backend)
+
 def dumps(obj):
     """
      Serialize ``obj`` to a JSON formatted ``str``.
@@ -63,7 +89,7 @@ def dumps(obj):
     :param obj:
     :return:
     """
-    return json.dumps(obj)
+    return _encode(obj)
 
 class APIError(StandardError):
     """
@@ -104,7 +130,73 @@ class APIPermissionError(APIError):
         super(APIPermissionError, self).__init__('permission:forbidden', 'permission', message)
 
 
-def api(func):
+def _is_iterator(obj):
+    return hasattr(obj, 'next') and hasattr(obj, '__iter__')
+
+def _iter_json(obj):
+    """
+    逐块序列化对象，生成器和迭代器序列化为数组，每次只序列化一个元素
+    只展开最外层的dict，其余的值整体序列化
+    :param obj:
+    :return:
+    """
+    if _is_iterator(obj):
+        yield '['
+        sep = ''
+        for item in obj:
+            yield sep + dumps(item)
+            sep = ','
+        yield ']'
+    elif isinstance(obj, dict):
+        sep = '{'
+        for k, v in obj.iteritems():
+            yield '%s%s:' % (sep, dumps(k))
+            sep = ','
+            if _is_iterator(v):
+                for chunk in _iter_json(v):
+                    yield chunk
+            else:
+                yield dumps(v)
+        yield '}' if sep == ',' else '{}'
+    else:
+        yield dumps(obj)
+
+def _buffered(chunks, buffer_size=8192):
+    """
+    把小块合并成不小于 buffer_size 的块，减少写socket的次数
+    :param chunks:
+    :param buffer_size:
+    :return:
+    """
+    L = []
+    size = 0
+    for chunk in chunks:
+        L.append(chunk)
+        size += len(chunk)
+        if size >= buffer_size:
+            yield ''.join(L)
+            L = []
+            size = 0
+    if L:
+        yield ''.join(L)
+
+def _stream(first, chunks):
+    """
+    发送已经生成的第一块，再继续发送剩余的块
+    这时响应已经开始发送，出错时只能记录日志并中断连接
+    :param first:
+    :param chunks:
+    :return:
+    """
+    yield first
+    try:
+        for chunk in chunks:
+            yield chunk
+    except Exception, e:
+        logging.exception(e)
+        raise
+
+def api(func=None, stream=False):
     """
     A decorator that makes a function to json api, makes the return value as json.
     将函数返回结果 转换成json 的装饰器
@@ -115,16 +207,34 @@ def api(func):
     @api
     def api_test():
         return dict(result='123', items=[])
+    stream=True 时返回编码后的数据块的生成器，不在内存中生成整个json，
+    返回值中的生成器（比如 Model.iter_by 的结果）序列化为数组，逐行从游标读取并发送：
+    @api(stream=True)
+    @get('/api/comments')
+    def api_get_comments():
+        return dict(comments=Comment.iter_by('order by created_at desc'))
+    第一块数据在发送之前生成，在这之前抛出的 APIError 仍然返回错误信息
     """
+    if func is None:
+        return functools.partial(api, stream=stream)
+
     @functools.wraps(func)
     def _wrapper(*args, **kw):
         try:
-            r = dumps(func(*args, **kw))
+            r = func(*args, **kw)
+            if stream:
+                chunks = _buffered(_iter_json(r))
+                r = _stream(next(chunks, ''), chunks)
+            else:
+                r = dumps(r)
         except APIError, e:
-            r = json.dumps(dict(error=e.error, data=e.data, message=e.message))
+            r = dumps(dict(error=e.error, data=e.data, message=e.message))
+        except _HttpError:
+            # 比如 check_not_modified 抛出的 304，交给框架处理
+            raise
         except Exception, e:
             logging.exception(e)
-            r = json.dumps(dict(error='internalerror', data=e.__class__.__name__, message=e.message))
+            r = dumps(dict(error='internalerror', data=e.__class__.__name__, message=e.message))
         ctx.response.content_type = 'application/json'
         return r
     return _wrapper
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+api 序列化的性能测试，不需要连接数据库
+对比：
+    before: 原来的实现，每次调用 json.dumps，使用默认的分隔符
+    after:  apis.dumps，重复使用同一个 JSONEncoder，紧凑的分隔符
+数据：
+    /api/blogs     一页15篇博客（不含content）和 Page
+    /api/comments  一页15条评论和 Page
+运行（transwarp.web 依赖上一级目录的 utils 包）：
+    PYTHONPATH=.. python bench_json.py
+"""
+
+import json
+import time
+import timeit
+
+import apis
+from apis import Page
+from models import Blog, Comment
+
+def _blogs_payload():
+    blogs = [Blog._load(dict(id='%050d' % i, user_id='%050d' % 1, user_name=u'Michael', user_image='http://www.gravatar.com/avatar/%032d' % i,
+                             name=u'博客标题 %d' % i, summary=u'摘要 ' * 20, created_at=time.time()), deferred=('content',))
+             for i in range(15)]
+    return dict(blogs=blogs, page=Page(1000, 2))
+
+def _comments_payload():
+    comments = [Comment._load(dict(id='%050d' % i, blog_id='%050d' % 1, user_id='%050d' % 2, user_name=u'Bob',
+                                   user_image='http://www.gravatar.com/avatar/%032d' % i, content=u'评论内容 ' * 30, created_at=time.time()))
+                for i in range(15)]
+    return dict(comments=comments, page=Page(1000, 2))
+
+def _before(obj):
+    return json.dumps(obj, default=apis._dump)
+
+def main():
+    number = 20000
+    for name, payload in (('/api/blogs', _blogs_payload()), ('/api/comments', _comments_payload())):
+        assert json.loads(_before(payload)) == json.loads(apis.dumps(payload))
+        t_before = timeit.timeit(lambda: _before(payload), number=number)
+        t_after = timeit.timeit(lambda: apis.dumps(payload), number=number)
+        print '%-14s before: %.2f us  after: %.2f us  size: %d => %d bytes' % (
+            name, t_before / number * 1e6, t_after / number * 1e6, len(_before(payload)), len(apis.dumps(payload)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+orm 每次调用的额外开销测试，不需要连接数据库
+对比：
+    before: 每次调用都遍历 __mappings__ 拼接SQL，再做 ? => %s 替换
+    after:  使用 ModelMetaclass 预先生成的SQL，只收集参数，SQL从语句缓存中取得
+运行：
+    python bench_orm.py
+"""
+
+import timeit
+
+from transwarp import db
+from models import Blog
+
+def _before_insert(obj):
+    params = {}
+    for k, v in obj.__mappings__.iteritems():
+        if v.insertable:
+            if not hasattr(obj, k):
+                setattr(obj, k, v.default)
+            params[v.name] = getattr(obj, k)
+    cols, args = zip(*params.iteritems())
+    sql = 'insert into `%s` (%s) values (%s)' % (obj.__table__, ','.join(['`%s`' % col for col in cols]), ','.join(['?' for i in range(len(cols))]))
+    return sql.replace('?', '%s'), args
+
+def _before_update(obj):
+    L = []
+    args = []
+    for k, v in obj.__mappings__.iteritems():
+        if v.updatable:
+            if hasattr(obj, k):
+                arg = getattr(obj, k)
+            else:
+                arg = v.default
+                setattr(obj, k, arg)
+            L.append('`%s`=?' % k)
+            args.append(arg)
+    pk = obj.__primary_key__.name
+    args.append(getattr(obj, pk))
+    sql = 'update `%s` set %s where `%s`=?' % (obj.__table__, ','.join(L), pk)
+    return sql.replace('?', '%s'), args
+
+def _before_get(cls, pk):
+    sql = 'select * from `%s` where `%s`=?' % (cls.__table__, cls.__primary_key__.name)
+    return sql.replace('?', '%s'), (pk,)
+
+def _after_insert(obj):
+    return db._compile(obj.__insert_sql__).sql, obj._insert_args()
+
+def _after_update(obj):
+    return db._compile(obj.__update_sql__).sql, obj._update_args()
+
+def _after_get(cls, pk):
+    return db._compile(cls.__get_sql__).sql, (pk,)
+
+def bench(name, fn, number=100000):
+    t = min(timeit.repeat(fn, number=number, repeat=3))
+    print '%-16s %8.3f us/call' % (name, t / number * 1e6)
+    return t
+
+if __name__ == '__main__':
+    blog = Blog(id='1', user_id='u', user_name='Michael', name='Test', summary='summary', content='content' * 100, created_at=0.0)
+    for op, before, after in [
+            ('insert', lambda: _before_insert(blog), lambda: _after_insert(blog)),
+            ('update', lambda: _before_update(blog), lambda: _after_update(blog)),
+            ('get', lambda: _before_get(Blog, '1'), lambda: _after_get(Blog, '1'))]:
+        t1 = bench('%s before' % op, before)
+        t2 = bench('%s after' % op, after)
+        print '%-16s %8.1fx' % ('%s speedup' % op, t1 / t2)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+路由查找的性能测试，不需要连接数据库
+对比：
+    linear: 原来的实现，静态路由查字典，动态路由逐个尝试正则
+    router: 启动时编译的 _Router，按路径分段查找前缀树
+运行（transwarp.web 依赖上一级目录的 utils 包）：
+    PYTHONPATH=.. python bench_router.py
+"""
+
+import timeit
+
+from transwarp.web import get, post, Route, StaticFileRoute, _Router
+
+def _make_routes(n):
+    """
+    生成n个资源，每个资源有列表、详情、子资源、删除 4个路由
+    :param n:
+    :return:
+    """
+    routes = []
+    def _add(decorator, path):
+        fn = decorator(path)(lambda *args: args)
+        routes.append(Route(fn))
+    for i in range(n):
+        _add(get, '/api/res%d' % i)
+        _add(get, '/api/res%d/:id' % i)
+        _add(get, '/api/res%d/:id/items/:item_id' % i)
+        _add(post, '/api/res%d/:id/delete' % i)
+    return routes
+
+def _linear(routes):
+    get_static, get_dynamic = {}, []
+    for route in routes:
+        if route.method == 'GET':
+            if route.is_static:
+                get_static[route.path] = route
+            else:
+                get_dynamic.append(route)
+    get_dynamic.append(StaticFileRoute())
+    def match(path):
+        fn = get_static.get(path)
+        if fn:
+            return fn, ()
+        for fn in get_dynamic:
+            args = fn.match(path)
+            if args:
+                return fn, args
+        return None
+    return match
+
+def _compiled(routes):
+    router = _Router()
+    for route in routes:
+        router.add(route)
+    router.add(StaticFileRoute())
+    return lambda path: router.match('GET', path)
+
+def bench(name, fn, number=20000):
+    t = min(timeit.repeat(fn, number=number, repeat=3))
+    print '%-28s %8.3f us/lookup' % (name, t / number * 1e6)
+    return t
+
+if __name__ == '__main__':
+    for n in (25, 100):
+        routes = _make_routes(n)
+        linear, compiled = _linear(routes), _compiled(routes)
+        paths = ['/api/res0/123', '/api/res%d/123/items/456' % (n - 1), '/static/css/uikit.min.css', '/not/found']
+        for path in paths:
+            assert (linear(path) is None) == (compiled(path) is None)
+        print '%d routes:' % len(routes)
+        for path in paths:
+            t1 = bench('  linear %s' % path, lambda: linear(path))
+            t2 = bench('  router %s' % path, lambda: compiled(path))
+            print '  %-26s %8.1fx' % ('speedup', t1 / t2)
@@ -9,9 +9,45 @@ configs = {
         'port': 3306,
         'user': 'root',
         'password': '123456',
-        'database': 'awesome'
+        'database': 'awesome',
+        'pool_size': 5,
+        'max_overflow': 10,
+        'pool_timeout': 30,
+        'recycle': 3600
     },
     'session':{
         'secret': 'AwEsOmE'
+    },
+    'cache':{
+        'backend': 'local',
+        'servers': ['127.0.0.1:11211']
+    },
+    'compress':{
+        'enabled': True,
+        'level': 6,
+        'min_size': 1024
+    },
+    'template':{
+        'bytecode_cache': '',
+        'precompile': True
+    },
+    'render':{
+        'processes': 0,
+        'timeout': 2.0,
+        'min_size': 2000
+    },
+    'static':{
+        'enabled': True,
+        'check_interval': 10,
+        'cache_bytes': 16 * 1024 * 1024,
+        'cache_file_size': 64 * 1024
+    },
+    'server':{
+        'server': 'threaded',
+        'debug': False,
+        'threads': 10,
+        'processes': 1,
+        'backlog': 128,
+        'keepalive_timeout': 5
     }
 }
\ No newline at end of file
@@ -8,5 +8,10 @@ Override configurations.
 configs = {
     'db': {
         'host': '127.0.0.1'
-    }
+    },
+    # 开发时打开debug：显示错误详情、模板自动重新加载、由应用直接提供静态文件
+    # 'server': {
+    #     'server': 'wsgiref',
+    #     'debug': True
+    # }
 }
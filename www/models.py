@@ -6,6 +6,9 @@
 import time, uuid
 from transwarp.db import next_id
 from transwarp.orm import Model, StringField, BooleanField, FloatField, TextField
+from transwarp.web import invalidate_tags, invalidate_fragments
+import render
+import sessions
 
 def next_id():
     return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)
@@ -13,6 +16,7 @@ def next_id():
 
 class User(Model):
     __table__ = 'users'
+    # 不开启二级缓存：缓存的行包含密码散列，使用 memcached 时会被序列化到共享缓存中
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     email = StringField(updatable=False, ddl='varchar(50)')
@@ -22,10 +26,16 @@ class User(Model):
     image = StringField(ddl='varchar(500)')
     created_at = FloatField(updatable=False, default=time.time)
 
+    def post_update(self):
+        # 修改密码等操作后，已缓存的会话需要重新校验
+        sessions.invalidate_user(self.id)
+
+    post_delete = post_update
 
 
 class Blog(Model):
     __table__ = 'blogs'
+    __cache__ = dict(ttl=60)
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     user_id = StringField(updatable=False, ddl='varchar(50)')
@@ -36,6 +46,15 @@ class Blog(Model):
     content = TextField()
     created_at = FloatField(updatable=False, default=time.time)
 
+    def post_insert(self):
+        invalidate_tags('blogs', 'blog:%s' % self.id)
+
+    def post_update(self):
+        invalidate_tags('blogs', 'blog:%s' % self.id)
+        render.invalidate(self.id)
+
+    post_delete = post_update
+
 class Comment(Model):
     __table__ = 'comments'
 
@@ -47,6 +66,8 @@ class Comment(Model):
     content = TextField()
     created_at = FloatField(updatable=False, default=time.time)
 
+    def post_insert(self):
+        invalidate_tags('blog:%s' % self.blog_id)
+        invalidate_fragments('blog:%s:comments' % self.blog_id)
 
-
-
+    post_update = post_delete = post_insert
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+博客内容的渲染
+markdown2 是纯python实现，渲染长文章很耗CPU，渲染结果按博客缓存：
+    缓存以博客id 为key，保存内容的md5 和渲染出的html，内容的md5 不一致时重新渲染，
+    所以其它进程修改了博客后也不会读到旧的html
+    缓存按html的长度限制总大小，博客修改、删除后由 Blog 的触发器调用 invalidate() 释放
+较长的内容在进程池中渲染：
+    不占用请求线程的GIL，多核时可以并行渲染
+    进程池由 start() 在启动工作线程、连接数据库之前创建，pre-fork 时每个子进程各创建一次，
+    没有调用 start() 时所有内容都在请求线程中渲染
+    超过 timeout 秒没有完成时返回转义后的纯文本，只结束正在渲染这段内容的进程，
+    进程池会补上新的进程，其它线程的渲染不受影响
+"""
+
+import os
+import cgi
+import time
+import signal
+import hashlib
+import logging
+import itertools
+import threading
+import multiprocessing
+
+import markdown2
+
+from transwarp import cache
+
+_html_cache = cache.LRUCache(10000, name='render.markdown', maxbytes=32 * 1024 * 1024)
+
+# 渲染超时后，纯文本结果的缓存时间，避免每次访问都等待超时
+_FALLBACK_TTL = 60
+
+_config = dict(processes=0, timeout=2.0, min_size=2000)
+_pool = None
+# 进程池进程共享的数组，每个进程占两项：(pid, 正在渲染的任务编号)，用于超时时找到并结束该进程
+_slots = None
+# 进程池进程中：自己在 _slots 中的下标
+_slot = None
+_task_ids = itertools.count(1)
+
+def configure(processes=0, timeout=2.0, min_size=2000):
+    """
+    :param processes: 进程池的进程数，0 表示CPU核数，None 表示不使用进程池
+    :param timeout: 每次渲染的超时秒数
+    :param min_size: 内容短于这个长度时直接在当前线程渲染，进程间通信的开销比渲染还大
+    :return:
+    """
+    _config.update(processes=processes, timeout=timeout, min_size=min_size)
+
+def start(close_fds=()):
+    """
+    创建当前进程的进程池
+    进程池的进程是fork 出来的，会复制调用时进程的状态，所以需要在启动工作线程、
+    打开数据库连接之前调用，pre-fork 时作为 HTTPServer 的 initializer 在每个子进程中调用
+    :param close_fds: 进程池的进程中需要关闭的文件描述符，比如监听socket
+    :return:
+    """
+    global _pool, _slots
+    if _config['processes'] is None or _pool is not None:
+        return
+    n = _config['processes'] or multiprocessing.cpu_count()
+    # 被结束的进程要等进程池补上新进程后才释放位置，多留一些
+    _slots = multiprocessing.Array('l', n * 4)
+    _pool = multiprocessing.Pool(n, _init_worker, (os.getpid(), _slots, tuple(close_fds)))
+
+def _watch_parent(ppid):
+    """
+    父进程退出后（比如被 os._exit 结束的 pre-fork 子进程）进程池的进程也退出
+    :param ppid:
+    :return:
+    """
+    while os.getppid() == ppid:
+        time.sleep(1)
+    os._exit(0)
+
+def _init_worker(ppid, slots, close_fds):
+    global _slots, _slot
+    for fd in close_fds:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+    _slots = slots
+    with slots.get_lock():
+        for i in range(0, len(slots), 2):
+            if slots[i] == 0:
+                slots[i] = os.getpid()
+                slots[i + 1] = 0
+                _slot = i
+                break
+    t = threading.Thread(target=_watch_parent, args=(ppid,))
+    t.daemon = True
+    t.start()
+
+def _render(task_id, deadline, content):
+    """
+    在进程池的进程中渲染，渲染期间在 _slots 中记录任务编号
+    排队时已经超时的任务不再渲染
+    :param task_id:
+    :param deadline:
+    :param content:
+    :return:
+    """
+    if time.time() > deadline:
+        return None
+    if _slot is not None:
+        _slots[_slot + 1] = task_id
+    try:
+        return markdown2.markdown(content)
+    finally:
+        if _slot is not None:
+            # 加锁清除，见 _kill_task
+            with _slots.get_lock():
+                _slots[_slot + 1] = 0
+
+def _kill_task(task_id):
+    """
+    结束正在渲染 task_id 的进程，进程池会自动补上新的进程
+    持有 _slots 的锁直到发出信号：进程清除任务编号也需要这个锁，
+    所以此时进程一定还在 markdown2 中，没有开始写结果队列（不会带着队列的锁被结束），也没有接下一个任务
+    :param task_id:
+    :return: 是否找到该进程
+    """
+    with _slots.get_lock():
+        for i in range(0, len(_slots), 2):
+            if _slots[i + 1] == task_id:
+                pid = _slots[i]
+                _slots[i] = _slots[i + 1] = 0
+                break
+        else:
+            return False
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+    return True
+
+def _plain_text(content):
+    return u'<pre>%s</pre>' % cgi.escape(content)
+
+def markdown(content):
+    """
+    渲染markdown，返回 (html, 是否渲染成功)
+    :param content:
+    :return:
+    """
+    if _pool is None or len(content) < _config['min_size']:
+        return markdown2.markdown(content), True
+    task_id = next(_task_ids)
+    timeout = _config['timeout']
+    try:
+        return _pool.apply_async(_render, (task_id, time.time() + timeout, content)).get(timeout), True
+    except multiprocessing.TimeoutError:
+        logging.warning('Render markdown timeout, %d chars.' % len(content))
+        _kill_task(task_id)
+    except Exception, e:
+        logging.exception(e)
+    return _plain_text(content), False
+
+def _content_hash(content):
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return hashlib.md5(content).hexdigest()
+
+def blog_html(blog):
+    """
+    返回博客内容渲染后的html
+    :param blog: 需要包含 id 和 content
+    :return:
+    """
+    h = _content_hash(blog.content)
+    entry = _html_cache.get(blog.id)
+    if entry is not None and entry[0] == h:
+        return entry[1]
+    html, ok = markdown(blog.content)
+    _html_cache.set(blog.id, (h, html), ttl=None if ok else _FALLBACK_TTL, size=len(html))
+    return html
+
+def invalidate(blog_id):
+    """
+    删除博客的渲染缓存
+    :param blog_id:
+    :return:
+    """
+    _html_cache.delete(blog_id)
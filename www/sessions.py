@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+会话缓存
+每个请求都要校验会话cookie（查询用户、计算md5），校验通过的结果按cookie 缓存：
+    key 为 '<用户id>:<cookie>'，只保存用户的公开字段（不包含密码），
+    命中时由调用者用这些字段创建新的 User 对象，缓存的数据不会被请求修改，也不会在线程之间共享
+    过期时间不超过cookie 本身的过期时间
+    用户修改（比如修改密码）后由 User 的触发器调用 invalidate_user() 使该用户的所有会话失效，
+    退出登录时调用 invalidate() 使当前会话失效
+默认使用进程内缓存，失效只对当前进程生效，所以 pre-fork 多进程部署时
+必须通过 set_cache() 换成带共享缓存的 cache.FragmentCache，否则应调用 set_cache(None) 关闭会话缓存
+"""
+
+import time
+import functools
+
+from transwarp import db, cache
+
+# 会话缓存的最长时间，用户被其它进程修改后最多这么久之后重新校验
+_SESSION_TTL = 600
+
+# 缓存的用户字段
+_USER_FIELDS = ('id', 'name', 'email', 'admin', 'image')
+
+_session_cache = cache.FragmentCache(cache.LRUCache(10000), ttl=_SESSION_TTL, name='sessions')
+
+def set_cache(session_cache):
+    """
+    替换会话缓存，多进程部署时使用带共享缓存的 cache.FragmentCache，失效对所有进程生效
+    :param session_cache: 为None时不缓存会话
+    :return:
+    """
+    global _session_cache
+    _session_cache = session_cache
+
+def _key(user_id, cookie_str):
+    return '%s:%s' % (user_id, cookie_str)
+
+def lookup(user_id, cookie_str):
+    """
+    读取缓存的会话，只读不写，cookie 校验通过后才由 set_user 写入缓存，
+    伪造的cookie 不会在缓存中留下任何条目
+    :param user_id:
+    :param cookie_str:
+    :return: (用户字段的字典, 代数)，不存在时字典为None，代数需要传给 set_user
+    """
+    if _session_cache is None:
+        return None, None
+    return _session_cache.lookup(_key(user_id, cookie_str))
+
+def set_user(user_id, cookie_str, user, expires, gens=None):
+    """
+    缓存校验通过的会话
+    :param user_id:
+    :param cookie_str:
+    :param user:
+    :param expires: cookie 的过期时间戳
+    :param gens: lookup 返回的代数，校验期间用户被修改时不会写入旧的数据
+    :return:
+    """
+    if _session_cache is None:
+        return
+    ttl = min(_SESSION_TTL, int(expires - time.time()))
+    if ttl > 0:
+        fields = dict((k, user[k]) for k in _USER_FIELDS if k in user)
+        _session_cache.set(_key(user_id, cookie_str), fields, ttl, gens)
+
+def invalidate(user_id, cookie_str):
+    if _session_cache is not None:
+        _session_cache.invalidate(_key(user_id, cookie_str))
+
+def invalidate_user(user_id):
+    """
+    使用户的所有会话失效，在事务中调用时等事务提交后再失效
+    :param user_id:
+    :return:
+    """
+    if _session_cache is not None:
+        db.after_commit(functools.partial(_session_cache.invalidate, str(user_id)))
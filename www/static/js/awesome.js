@@ -138,6 +138,27 @@ if (! Number.prototype.toDateTime) {
     };
 }
 
+if (! Number.prototype.toSmartString) {
+    // 与服务端的 datetime 过滤器一致，在浏览器中显示相对时间，用于会被缓存的页面片段
+    Number.prototype.toSmartString = function() {
+        var delta = Math.floor(new Date().getTime() / 1000 - this);
+        if (delta < 60) {
+            return '1分钟前';
+        }
+        if (delta < 3600) {
+            return Math.floor(delta / 60) + '分钟前';
+        }
+        if (delta < 86400) {
+            return Math.floor(delta / 3600) + '小时前';
+        }
+        if (delta < 604800) {
+            return Math.floor(delta / 86400) + '天前';
+        }
+        var dt = new Date(this * 1000);
+        return dt.getFullYear() + '年' + (dt.getMonth() + 1) + '月' + dt.getDate() + '日';
+    };
+}
+
 function gotoPage(index) {
     if (index) {
         var search = location.search;
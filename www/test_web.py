@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+web、orm 中不依赖数据库和WSGI Server 的辅助函数的单元测试
+在 www 目录下运行:
+    python -m unittest test_web
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from transwarp import web, orm
+
+
+class ParseRangeTest(unittest.TestCase):
+
+    def test_range(self):
+        self.assertEqual(web._parse_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(web._parse_range('bytes=100-', 1000), (100, 999))
+        self.assertEqual(web._parse_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(web._parse_range('bytes = 0 - 9', 1000), (0, 9))
+
+    def test_clamp(self):
+        self.assertEqual(web._parse_range('bytes=900-2000', 1000), (900, 999))
+        self.assertEqual(web._parse_range('bytes=-2000', 1000), (0, 999))
+
+    def test_unsatisfiable(self):
+        self.assertIs(web._parse_range('bytes=1000-', 1000), False)
+        self.assertIs(web._parse_range('bytes=5-1', 1000), False)
+        self.assertIs(web._parse_range('bytes=-0', 1000), False)
+
+    def test_ignored(self):
+        self.assertIsNone(web._parse_range('bytes=0-1,5-9', 1000))
+        self.assertIsNone(web._parse_range('bytes=-', 1000))
+        self.assertIsNone(web._parse_range('items=0-9', 1000))
+
+    def test_empty_file(self):
+        self.assertIsNone(web._parse_range('bytes=-5', 0))
+        self.assertIsNone(web._parse_range('bytes=0-', 0))
+
+
+class AcceptEncodingTest(unittest.TestCase):
+
+    def test_prefer_gzip(self):
+        self.assertEqual(web._accept_encoding('gzip, deflate'), 'gzip')
+        self.assertEqual(web._accept_encoding('deflate, gzip'), 'gzip')
+        self.assertEqual(web._accept_encoding('gzip ; q=0.2'), 'gzip')
+
+    def test_q_zero(self):
+        self.assertEqual(web._accept_encoding('gzip;q=0, deflate'), 'deflate')
+        self.assertEqual(web._accept_encoding('deflate;q=0.5, gzip;q=0'), 'deflate')
+        self.assertIsNone(web._accept_encoding('gzip;q=0, deflate;q=0'))
+
+    def test_wildcard(self):
+        self.assertEqual(web._accept_encoding('*'), 'gzip')
+        self.assertEqual(web._accept_encoding('gzip;q=0, *'), 'deflate')
+        self.assertIsNone(web._accept_encoding('gzip;q=0, deflate;q=0, *'))
+        self.assertIsNone(web._accept_encoding('*;q=0'))
+
+    def test_none(self):
+        self.assertIsNone(web._accept_encoding(''))
+        self.assertIsNone(web._accept_encoding('identity'))
+        self.assertIsNone(web._accept_encoding('br'))
+
+
+class _Response(object):
+    """
+    只记录header的响应对象，_raise_if_not_modified 只用到 set_header
+    """
+    def __init__(self):
+        self.headers = {}
+
+    def set_header(self, name, value):
+        self.headers[name] = value
+
+
+class NotModifiedTest(unittest.TestCase):
+
+    def _check(self, etag=None, last_modified=None, **environ):
+        environ.setdefault('REQUEST_METHOD', 'GET')
+        response = _Response()
+        try:
+            web._raise_if_not_modified(response, environ, etag, last_modified)
+        except web._HttpError, e:
+            return e.status[:3], response.headers.get('ETag')
+        return None, response.headers.get('ETag')
+
+    def test_etag_base(self):
+        self.assertEqual(web._etag_base('W/"abc"'), '"abc"')
+        self.assertEqual(web._etag_base('"abc-gzip"'), '"abc"')
+        self.assertEqual(web._etag_base('"abc-deflate"'), '"abc"')
+        self.assertEqual(web._etag_base('"abc"'), '"abc"')
+
+    def test_if_none_match(self):
+        self.assertEqual(self._check('"abc"', HTTP_IF_NONE_MATCH='"abc"')[0], '304')
+        self.assertEqual(self._check('"abc"', HTTP_IF_NONE_MATCH='"x", "abc"')[0], '304')
+        self.assertEqual(self._check('"abc"', HTTP_IF_NONE_MATCH='*')[0], '304')
+        self.assertEqual(self._check('"abc"', HTTP_IF_NONE_MATCH='"x"')[0], None)
+
+    def test_encoded_variant(self):
+        # 客户端缓存的是压缩后的表示，304 返回它的ETag
+        self.assertEqual(self._check('"abc"', HTTP_IF_NONE_MATCH='"abc-gzip"'), ('304', '"abc-gzip"'))
+
+    def test_if_modified_since(self):
+        since = 'Sun, 09 Sep 2001 01:46:40 GMT'
+        self.assertEqual(self._check(last_modified=1000000000, HTTP_IF_MODIFIED_SINCE=since)[0], '304')
+        self.assertEqual(self._check(last_modified=1000000001, HTTP_IF_MODIFIED_SINCE=since)[0], None)
+        # 有 If-None-Match 时忽略 If-Modified-Since
+        self.assertEqual(self._check('"abc"', 1000000000, HTTP_IF_NONE_MATCH='"x"', HTTP_IF_MODIFIED_SINCE=since)[0], None)
+
+    def test_unsafe_method(self):
+        self.assertEqual(self._check('"abc"', REQUEST_METHOD='POST', HTTP_IF_NONE_MATCH='"abc"')[0], None)
+
+
+class RouterTest(unittest.TestCase):
+
+    def setUp(self):
+        @web.get('/blog/:blog_id')
+        def blog(blog_id):
+            pass
+
+        @web.get('/blog/new')
+        def blog_new():
+            pass
+
+        @web.get('/user/:user_id/blog/:blog_id')
+        def user_blog(user_id, blog_id):
+            pass
+
+        @web.post('/api/blogs')
+        def api_create_blog():
+            pass
+
+        self.router = web._Router()
+        for func in (blog, blog_new, user_blog, api_create_blog):
+            self.router.add(web.Route(func))
+        self.static = web.StaticFileRoute(prefix='/static/')
+        self.router.add(self.static)
+
+    def _match(self, method, path):
+        r = self.router.match(method, path)
+        return r and (r[0].func.__name__ if hasattr(r[0], 'func') else r[0], tuple(r[1]))
+
+    def test_static_path(self):
+        self.assertEqual(self._match('POST', '/api/blogs'), ('api_create_blog', ()))
+        self.assertEqual(self._match('GET', '/blog/new'), ('blog_new', ()))
+
+    def test_dynamic_path(self):
+        self.assertEqual(self._match('GET', '/blog/123'), ('blog', ('123',)))
+        self.assertEqual(self._match('GET', '/user/1/blog/2'), ('user_blog', ('1', '2')))
+
+    def test_prefix_route(self):
+        self.assertEqual(self._match('GET', '/static/css/a.css'), (self.static, ('static/css/a.css',)))
+
+    def test_head_uses_get(self):
+        self.assertEqual(self._match('HEAD', '/blog/123'), ('blog', ('123',)))
+        self.assertTrue(self.router.has_method('HEAD'))
+
+    def test_no_match(self):
+        self.assertIsNone(self.router.match('GET', '/blog'))
+        self.assertIsNone(self.router.match('GET', '/blog/1/2'))
+        self.assertIsNone(self.router.match('GET', '/api/blogs'))
+        self.assertFalse(self.router.has_method('DELETE'))
+
+
+class StaticFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_missing_file_expires(self):
+        files = web._StaticFiles(self.root, check_interval=0.1)
+        files.scan()
+        path = os.path.join(self.root, 'a.css')
+        self.assertIsNone(files.lookup(path))
+        with open(path, 'w') as fp:
+            fp.write('body{}')
+        # 404 在 check_interval 内被缓存
+        self.assertIsNone(files.lookup(path))
+        time.sleep(0.15)
+        self.assertEqual(files.lookup(path).size, 6)
+
+    def test_missing_files_bounded(self):
+        files = web._StaticFiles(self.root, check_interval=10, max_missing=10)
+        for i in range(100):
+            files.lookup(os.path.join(self.root, 'x%d' % i))
+        self.assertEqual(len(files._missing), 10)
+        self.assertEqual(len(files._files), 0)
+
+
+class Item(orm.Model):
+    __table__ = 'items'
+
+    id = orm.StringField(primary_key=True)
+    name = orm.StringField()
+    count = orm.IntegerField()
+    created_at = orm.FloatField(updatable=False)
+
+
+class DirtyArgsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.item = Item(id='1', name='a', count=1, created_at=1.0)
+        self.item._take_snapshot()
+
+    def test_unchanged(self):
+        self.assertEqual(self.item._dirty_args(self.item._snapshot), ((), []))
+
+    def test_changed(self):
+        self.item.name = 'b'
+        self.assertEqual(self.item._dirty_args(self.item._snapshot), (('name',), ['b']))
+
+    def test_not_updatable(self):
+        self.item.created_at = 2.0
+        self.item.count = 2
+        self.assertEqual(self.item._dirty_args(self.item._snapshot), (('count',), [2]))
+
+    def test_missing_from_snapshot(self):
+        item = Item(id='2', name='x')
+        item._take_snapshot()
+        item.count = 3
+        self.assertEqual(item._dirty_args(item._snapshot), (('count',), [3]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,553 @@
+# -*- coding: utf-8 -*-
+"""
+cache模块设计的原因：
+    1. 统一缓存实现
+        db、orm、web 各层都有需要缓存的数据（编译后的SQL、查询结果、页面等），
+        统一使用本模块提供的缓存对象，避免各自实现一套
+    2. 统一统计信息
+        每个缓存对象都记录 命中、未命中、淘汰 次数，按名字注册后可以通过 stats() 一次取得，
+        方便根据命中率调整缓存大小
+设计cache接口：
+    1. 创建缓存
+        from transwarp import cache
+        c = cache.LRUCache(maxsize=1000, ttl=60, name='users')
+        c = cache.ClockCache(maxsize=256, name='statements')     # 近似LRU，命中不加锁
+    2. 读写缓存
+        c.set('key', value)
+        c.get('key')        # => value，不存在或已过期返回None
+        c.delete('key')
+    3. 使用memcached
+        c = cache.MemcacheCache(['127.0.0.1:11211'], ttl=60, name='users')
+        接口与 LRUCache 相同，多个进程、多台机器可以共享缓存
+    4. 按前缀失效的缓存
+        c = cache.FragmentCache(shared=cache.MemcacheCache(['127.0.0.1:11211']), name='fragments')
+        c.set('blog:123:comments', html)
+        c.invalidate('blog:123')      # 'blog:123' 开头的key 全部失效
+    5. 查看统计信息
+        cache.stats()
+        # => {'users': {'hits': 10, 'misses': 2, 'evictions': 0, 'size': 2, 'maxsize': 1000}}
+"""
+
+import threading
+import time
+import socket
+import logging
+import hashlib
+import zlib
+import uuid
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+def register(name, obj):
+    """
+    按名字注册一个缓存对象，注册后其统计信息会出现在 stats() 的结果里
+    :param name:
+    :param obj: 需要实现 stats() 方法
+    :return:
+    """
+    with _registry_lock:
+        _registry[name] = obj
+    return obj
+
+def stats():
+    """
+    返回所有已注册缓存的统计信息
+    :return:
+    """
+    with _registry_lock:
+        items = _registry.items()
+    return dict((name, obj.stats()) for name, obj in items)
+
+# 双向链表节点的下标
+_PREV, _NEXT, _KEY, _VALUE, _EXPIRES, _REF, _SIZE = 0, 1, 2, 3, 4, 5, 6
+
+class LRUCache(object):
+    """
+    线程安全的进程内LRU缓存
+    使用 字典 + 双向循环链表 实现：
+        字典保存 key => 链表节点
+        链表按使用顺序排列，root._NEXT 是最久未使用的节点，root._PREV 是最近使用的节点
+        命中时把节点移到链表尾部，超出 maxsize 时淘汰链表头部的节点
+    maxsize: 最多保存的条目数，超出时淘汰最久未使用的条目
+    ttl: 默认的过期秒数，为None时不过期
+    maxbytes: 所有条目 size 的总和上限，为None时不限制，条目的size 由 set 传入
+    """
+    def __init__(self, maxsize=1000, ttl=None, name=None, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self._map = {}
+        self._root = root = []
+        root[:] = [root, root, None, None, None, False, 0]
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if name:
+            register(name, self)
+
+    def _unlink(self, link):
+        link_prev, link_next = link[_PREV], link[_NEXT]
+        link_prev[_NEXT] = link_next
+        link_next[_PREV] = link_prev
+
+    def _append(self, link):
+        root = self._root
+        last = root[_PREV]
+        last[_NEXT] = root[_PREV] = link
+        link[_PREV] = last
+        link[_NEXT] = root
+
+    def _evict(self):
+        """
+        淘汰最久未使用的条目直到不超过 maxsize 和 maxbytes，调用前需要持有锁
+        :return:
+        """
+        root = self._root
+        maxbytes = self.maxbytes
+        while len(self._map) > self.maxsize or (maxbytes is not None and self.bytes > maxbytes):
+            oldest = root[_NEXT]
+            self._unlink(oldest)
+            del self._map[oldest[_KEY]]
+            self.bytes -= oldest[_SIZE]
+            self.evictions = self.evictions + 1
+
+    def get(self, key, default=None):
+        """
+        读取缓存，不存在或已过期时返回default
+        :param key:
+        :param default:
+        :return:
+        """
+        with self._lock:
+            link = self._map.get(key)
+            if link is not None:
+                expires = link[_EXPIRES]
+                if expires is None or expires > time.time():
+                    self._unlink(link)
+                    self._append(link)
+                    self.hits = self.hits + 1
+                    return link[_VALUE]
+                self._unlink(link)
+                del self._map[key]
+                self.bytes -= link[_SIZE]
+            self.misses = self.misses + 1
+            return default
+
+    def get_many(self, keys):
+        """
+        批量读取缓存，只返回命中的条目
+        :param keys:
+        :return: key => value 的字典
+        """
+        r = {}
+        missing = object()
+        for key in keys:
+            value = self.get(key, missing)
+            if value is not missing:
+                r[key] = value
+        return r
+
+    def set(self, key, value, ttl=None, size=0):
+        """
+        写入缓存，ttl为None时使用默认的过期时间
+        :param key:
+        :param value:
+        :param ttl:
+        :param size: 条目占用的字节数，用于 maxbytes 限制
+        :return:
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            link = self._map.get(key)
+            if link is not None:
+                self._unlink(link)
+                self.bytes += size - link[_SIZE]
+                link[_VALUE] = value
+                link[_EXPIRES] = expires
+                link[_REF] = False
+                link[_SIZE] = size
+                self._append(link)
+            else:
+                link = [None, None, key, value, expires, False, size]
+                self._map[key] = link
+                self.bytes += size
+                self._append(link)
+            self._evict()
+
+    def delete(self, key):
+        """
+        删除缓存，返回是否删除成功
+        :param key:
+        :return:
+        """
+        with self._lock:
+            link = self._map.pop(key, None)
+            if link is None:
+                return False
+            self._unlink(link)
+            self.bytes -= link[_SIZE]
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._map.clear()
+            root = self._root
+            root[:] = [root, root, None, None, None, False, 0]
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def stats(self):
+        """
+        返回缓存的统计信息
+        :return:
+        """
+        r = dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                 size=len(self._map), maxsize=self.maxsize)
+        if self.maxbytes is not None:
+            r.update(bytes=self.bytes, maxbytes=self.maxbytes)
+        return r
+
+
+class ClockCache(LRUCache):
+    """
+    近似LRU的进程内缓存（CLOCK 二次机会算法），接口与 LRUCache 相同
+    链表按写入顺序排列，命中时只给节点打上访问标记，不加锁，也不移动节点；
+    淘汰时从最早写入的节点开始检查，有访问标记的节点清除标记后移到链表尾部，
+    没有访问标记的节点被淘汰
+    适合命中率高、读远多于写的热点缓存（比如 db 的语句缓存），命中不再需要争抢锁；
+    代价是淘汰顺序只是近似LRU，命中计数不加锁，多线程下是近似值
+    """
+    def _evict(self):
+        root = self._root
+        maxbytes = self.maxbytes
+        while len(self._map) > self.maxsize or (maxbytes is not None and self.bytes > maxbytes):
+            oldest = root[_NEXT]
+            self._unlink(oldest)
+            if oldest[_REF]:
+                oldest[_REF] = False
+                self._append(oldest)
+                continue
+            del self._map[oldest[_KEY]]
+            self.bytes -= oldest[_SIZE]
+            self.evictions = self.evictions + 1
+
+    def get(self, key, default=None):
+        link = self._map.get(key)
+        if link is not None:
+            expires = link[_EXPIRES]
+            if expires is None or expires > time.time():
+                link[_REF] = True
+                self.hits += 1
+                return link[_VALUE]
+            with self._lock:
+                if self._map.get(key) is link:
+                    self._unlink(link)
+                    del self._map[key]
+                    self.bytes -= link[_SIZE]
+        self.misses += 1
+        return default
+
+
+class MemcacheCache(object):
+    """
+    memcached 缓存，使用memcached文本协议，不依赖第三方库
+    接口与 LRUCache 相同，值使用pickle序列化，适合多进程、多台机器共享的缓存
+    servers: ['host:port', ...]，按key的crc32选择服务器
+    每个线程对每台服务器保持一个连接，网络错误时关闭连接，读取按未命中处理，写入和删除记录错误次数
+    """
+    _FLAG_PICKLE = 1
+
+    def __init__(self, servers=('127.0.0.1:11211',), ttl=None, name=None, timeout=3):
+        self.servers = []
+        for server in servers:
+            host, port = server.rsplit(':', 1) if ':' in server else (server, 11211)
+            self.servers.append((host, int(port)))
+        self.ttl = ttl
+        self.timeout = timeout
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        if name:
+            register(name, self)
+
+    def _key(self, key):
+        """
+        memcached 的key不能超过250字节，也不能包含空白和控制字符，不符合时使用md5
+        :param key:
+        :return:
+        """
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        if len(key) > 250 or any(c <= ' ' or c == '\x7f' for c in key):
+            key = hashlib.md5(key).hexdigest()
+        return key
+
+    def _server(self, key):
+        return self.servers[(zlib.crc32(key) & 0xffffffff) % len(self.servers)]
+
+    def _connection(self, server):
+        """
+        返回当前线程连接到server的 (socket, 读取用的文件对象)
+        :param server:
+        :return:
+        """
+        conns = self._local.__dict__.setdefault('conns', {})
+        conn = conns.get(server)
+        if conn is None:
+            sock = socket.create_connection(server, self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = conns[server] = (sock, sock.makefile('rb'))
+        return conn
+
+    def _close(self, server):
+        conn = self._local.__dict__.get('conns', {}).pop(server, None)
+        if conn:
+            try:
+                conn[1].close()
+                conn[0].close()
+            except socket.error:
+                pass
+
+    def _command(self, server, data, reader):
+        """
+        发送命令，用reader读取响应，网络错误时关闭连接并抛出 socket.error
+        :param server:
+        :param data:
+        :param reader: 接收读取用的文件对象，返回解析后的结果
+        :return:
+        """
+        try:
+            sock, fp = self._connection(server)
+            sock.sendall(data)
+            return reader(fp)
+        except (socket.error, EOFError, ValueError):
+            self._close(server)
+            self.errors += 1
+            raise socket.error('memcached %s:%s error' % server)
+
+    def _read_values(self, fp):
+        """
+        读取 get 命令的响应
+        VALUE <key> <flags> <bytes>\r\n<data>\r\n ... END\r\n
+        :param fp:
+        :return:
+        """
+        r = {}
+        while True:
+            line = fp.readline()
+            if not line:
+                raise EOFError()
+            if line == 'END\r\n':
+                return r
+            parts = line.split()
+            if parts[0] != 'VALUE':
+                raise ValueError(line)
+            flags, length = int(parts[2]), int(parts[3])
+            data = fp.read(length + 2)[:-2]
+            r[parts[1]] = pickle.loads(data) if flags & self._FLAG_PICKLE else data
+
+    def _read_line(self, fp):
+        line = fp.readline()
+        if not line:
+            raise EOFError()
+        return line.rstrip('\r\n')
+
+    def get(self, key, default=None):
+        """
+        读取缓存，不存在、已过期或者网络错误时返回default
+        :param key:
+        :param default:
+        :return:
+        """
+        r = self.get_many([key])
+        return r[key] if key in r else default
+
+    def get_many(self, keys):
+        """
+        批量读取缓存，同一台服务器上的key用一条 get 命令读取
+        :param keys:
+        :return: key => value 的字典，只包含命中的条目
+        """
+        groups = {}
+        for key in keys:
+            k = self._key(key)
+            groups.setdefault(self._server(k), {})[k] = key
+        r = {}
+        for server, mapping in groups.iteritems():
+            try:
+                values = self._command(server, 'get %s\r\n' % ' '.join(mapping), self._read_values)
+            except socket.error, e:
+                logging.warning('[CACHE] %s' % e)
+                values = {}
+            for k, key in mapping.iteritems():
+                if k in values:
+                    r[key] = values[k]
+        self.hits += len(r)
+        self.misses += len(keys) - len(r)
+        return r
+
+    def set(self, key, value, ttl=None):
+        """
+        写入缓存，ttl为None时使用默认的过期时间
+        :param key:
+        :param value:
+        :param ttl:
+        :return:
+        """
+        if ttl is None:
+            ttl = self.ttl
+        k = self._key(key)
+        if isinstance(value, str):
+            flags, data = 0, value
+        else:
+            flags, data = self._FLAG_PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        try:
+            self._command(self._server(k), 'set %s %d %d %d\r\n%s\r\n' % (k, flags, int(ttl or 0), len(data), data), self._read_line)
+        except socket.error, e:
+            logging.warning('[CACHE] %s' % e)
+
+    def delete(self, key):
+        """
+        删除缓存，返回是否删除成功
+        :param key:
+        :return:
+        """
+        k = self._key(key)
+        try:
+            return self._command(self._server(k), 'delete %s\r\n' % k, self._read_line) == 'DELETED'
+        except socket.error, e:
+            logging.warning('[CACHE] %s' % e)
+            return False
+
+    def _server_stats(self, server):
+        def _read(fp):
+            r = {}
+            while True:
+                line = self._read_line(fp)
+                if line == 'END':
+                    return r
+                parts = line.split(' ', 2)
+                r[parts[1]] = parts[2]
+        return self._command(server, 'stats\r\n', _read)
+
+    def stats(self):
+        """
+        返回缓存的统计信息，evictions 和 size 是所有服务器的合计
+        :return:
+        """
+        evictions = size = 0
+        for server in self.servers:
+            try:
+                st = self._server_stats(server)
+            except socket.error:
+                continue
+            evictions += int(st.get('evictions', 0))
+            size += int(st.get('curr_items', 0))
+        return dict(hits=self.hits, misses=self.misses, evictions=evictions, size=size, errors=self.errors)
+
+
+class FragmentCache(object):
+    """
+    支持按key前缀失效的缓存，用于缓存页面片段等
+    local: 进程内缓存，默认 LRUCache(1000)
+    shared: 多个进程共享的缓存，比如 MemcacheCache，不为None 时代替 local 保存所有数据
+    key 用 ':' 分段，比如 'blog:123:comments'，每个前缀（'blog'、'blog:123'、'blog:123:comments'）
+    有一个代数（generation），条目保存为 (写入时所有前缀的代数, 值)，
+    读取时用一次 get_many 同时取得条目和当前的代数，代数不一致时不命中，
+    invalidate('blog:123') 更新该前缀的代数后，该前缀下所有的key 都不再命中，旧的条目由淘汰或过期清除
+    代数和条目保存在同一个缓存中，所以使用 shared 时失效对所有进程生效
+    """
+    def __init__(self, local=None, shared=None, ttl=300, name=None):
+        if shared is not None:
+            self.store = shared
+        else:
+            self.store = local if local is not None else LRUCache(1000)
+        self.ttl = ttl
+        if name:
+            register(name, self)
+
+    def _gen_keys(self, key):
+        segments = key.split(':')
+        return ['gen:%s' % ':'.join(segments[:i]) for i in range(1, len(segments) + 1)]
+
+    def _current(self, gen_keys, values):
+        """
+        返回当前的代数元组，不存在的代数为None
+        :param gen_keys:
+        :param values: get_many 的结果
+        :return:
+        """
+        return tuple(values.get(k) for k in gen_keys)
+
+    def lookup(self, key):
+        """
+        读取条目，返回 (值, 当前的代数)，未命中时值为None
+        未命中时重新生成值后，把代数传给 set，生成期间发生的失效不会被覆盖
+        lookup 只读取缓存，不存在的代数由 set 生成，随意构造的key 不会写入缓存
+        :param key:
+        :return:
+        """
+        gen_keys = self._gen_keys(key)
+        values = self.store.get_many(gen_keys + [key])
+        gens = self._current(gen_keys, values)
+        entry = values.get(key)
+        if entry is not None and entry[0] == gens:
+            return entry[1], gens
+        return None, gens
+
+    def get(self, key, default=None):
+        value = self.lookup(key)[0]
+        return default if value is None else value
+
+    def set(self, key, value, ttl=None, gens=None):
+        """
+        写入条目，生成还不存在的代数
+        lookup 时不存在的代数在这之前已经被生成时（可能是生成值期间发生了失效），不写入
+        :param key:
+        :param value:
+        :param ttl:
+        :param gens: lookup 返回的代数，为None时读取当前的代数
+        :return:
+        """
+        if ttl is None:
+            ttl = self.ttl
+        gen_keys = self._gen_keys(key)
+        current = self._current(gen_keys, self.store.get_many(gen_keys))
+        if gens is None:
+            gens = current
+        L = []
+        for k, g, c in zip(gen_keys, gens, current):
+            if g is None:
+                if c is not None:
+                    return
+                g = uuid.uuid4().hex[:8]
+                self.store.set(k, g, ttl=0)
+            L.append(g)
+        self.store.set(key, (tuple(L), value), ttl)
+
+    def invalidate(self, prefix):
+        """
+        使以 prefix 开头（按 ':' 分段）的所有key 失效
+        :param prefix:
+        :return:
+        """
+        self.store.set('gen:%s' % prefix, uuid.uuid4().hex[:8], ttl=0)
+
+    def stats(self):
+        return self.store.stats()
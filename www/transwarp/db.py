@@ -15,6 +15,7 @@
           create_engine封装了如下功能:
               1. 为数据库连接 准备需要的配置信息
               2. 创建数据库连接(由生成的全局对象engine的 connect方法提供)
+              3. 创建连接池，连接用完后归还连接池而不是关闭，可通过 pool_stats() 查看统计信息
           from transwarp import db
           db.create_engine(user='root',
                            password='password',
@@ -46,17 +47,186 @@ import uuid
 import functools
 import logging
 
+import cache
+
 engine = None
 
+class _ConnectionPool(object):
+    """
+    线程安全的数据库连接池
+    空闲连接保存在 _idle 中，借出时优先复用空闲连接，否则新建连接，
+    最多同时存在 pool_size + max_overflow 个连接，超出时等待 timeout 秒
+    借出前检查连接：
+        1. 存活时间超过 recycle 秒的连接直接关闭重建
+        2. pre_ping 为True 时先 ping 一次，失败则关闭重建
+    归还时先 rollback，清除未提交的事务状态；空闲连接超过 pool_size 时关闭多余连接
+    """
+    def __init__(self, connect, pool_size=5, max_overflow=10, timeout=30, recycle=3600, pre_ping=True):
+        self._connect = connect
+        self._pool_size = pool_size
+        self._max_overflow = max_overflow
+        self._timeout = timeout
+        self._recycle = recycle
+        self._pre_ping = pre_ping
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = []                 # [(connection, created_at), ...]
+        self._created = {}              # id(connection) => created_at，仅记录借出的连接
+        self._total = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._timeouts = 0
+        self._recycled = 0
+
+    def _open(self):
+        """
+        新建一个数据库连接，失败时归还名额
+        :return:
+        """
+        try:
+            _connection = self._connect()
+        except:
+            with self._cond:
+                self._total = self._total - 1
+                self._cond.notify()
+            raise
+        logging.info('[CONNECTION] [OPEN] connection <%s>...' % hex(id(_connection)))
+        return _connection, time.time()
+
+    def _close(self, _connection):
+        logging.info('[CONNECTION] [CLOSE] connection <%s>...' % hex(id(_connection)))
+        try:
+            _connection.close()
+        except Exception:
+            pass
+
+    def _is_stale(self, _connection, created_at):
+        """
+        判断空闲连接是否已经失效
+        :param _connection:
+        :param created_at:
+        :return:
+        """
+        if self._recycle and time.time() - created_at > self._recycle:
+            return True
+        if self._pre_ping:
+            try:
+                _connection.ping()
+            except Exception:
+                return True
+        return False
+
+    def checkout(self):
+        """
+        从连接池借出一个连接
+        :return:
+        """
+        start = time.time()
+        waited = False
+        item = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    item = self._idle.pop()
+                    break
+                if self._total < self._pool_size + self._max_overflow:
+                    self._total = self._total + 1
+                    break
+                remaining = start + self._timeout - time.time()
+                if remaining <= 0:
+                    self._timeouts = self._timeouts + 1
+                    raise PoolTimeoutError('Connection pool exhausted: %s connections checked out, waited %.3fs.' % (self._total, time.time() - start))
+                waited = True
+                self._cond.wait(remaining)
+            self._checkouts = self._checkouts + 1
+            if waited:
+                self._waits = self._waits + 1
+                self._wait_time = self._wait_time + (time.time() - start)
+        if item is None:
+            item = self._open()
+        elif self._is_stale(*item):
+            with self._cond:
+                self._recycled = self._recycled + 1
+            self._close(item[0])
+            item = self._open()
+        _connection, created_at = item
+        with self._cond:
+            self._created[id(_connection)] = created_at
+        return _connection
+
+    def checkin(self, _connection):
+        """
+        将连接归还连接池
+        :param _connection:
+        :return:
+        """
+        discard = False
+        try:
+            _connection.rollback()
+        except Exception:
+            discard = True
+        with self._cond:
+            created_at = self._created.pop(id(_connection), 0)
+            if discard or len(self._idle) >= self._pool_size:
+                self._total = self._total - 1
+            else:
+                self._idle.append((_connection, created_at))
+                _connection = None
+            self._cond.notify()
+        if _connection is not None:
+            self._close(_connection)
+
+    def dispose(self):
+        """
+        关闭所有空闲连接
+        :return:
+        """
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._total = self._total - len(idle)
+            self._cond.notify_all()
+        for _connection, created_at in idle:
+            self._close(_connection)
+
+    def stats(self):
+        """
+        返回连接池的统计信息
+        :return:
+        """
+        with self._cond:
+            return Dict(pool_size=self._pool_size,
+                        max_overflow=self._max_overflow,
+                        connections=self._total,
+                        checked_out=len(self._created),
+                        idle=len(self._idle),
+                        checkouts=self._checkouts,
+                        waits=self._waits,
+                        wait_time=self._wait_time,
+                        timeouts=self._timeouts,
+                        recycled=self._recycled)
+
 class _Engine(object):
     """
     数据库引擎对象
     用于保存 db模块的核心函数：create_engine 创建出来的数据库连接
+    pool 为None时不使用连接池，每次都新建连接，用完即关闭
     """
-    def __init__(self, connect):
+    def __init__(self, connect, pool=None):
         self._connect = connect
+        self.pool = pool
+
     def connect(self):
-        return self._connect()
+        if self.pool is not None:
+            return self.pool.checkout()
+        _connection = self._connect()
+        logging.info('[CONNECTION] [OPEN] connection <%s>...' % hex(id(_connection)))
+        return _connection
+
+    def release(self, _connection):
+        if self.pool is not None:
+            return self.pool.checkin(_connection)
+        logging.info('[CONNECTION] [CLOSE] connection <%s>...' % hex(id(_connection)))
+        _connection.close()
 
 class _LasyConnection(object):
     """
@@ -66,22 +236,22 @@ class _LasyConnection(object):
     def __init__(self):
         self.connection = None
 
-    def cursor(self):
+    def cursor(self, cursorclass=None):
         if self.connection is None:
-            _connection = engine.connect()
-            logging.info('[CONNECTION] [OPEN] connection <%s>...' % hex(id(_connection)))
-            self.connection = _connection
-        return self.connection.cursor()
+            self.connection = engine.connect()
+        return self.connection.cursor(cursorclass)
 
     def commit(self):
         self.connection.commit()
 
+    def rollback(self):
+        self.connection.rollback()
+
     def cleanup(self):
         if self.connection:
             _connection =self.connection
             self.connection = None
-            logging.info('[CONNECTION] [CLOSE] connection <%s>...' % hex(id(_connection)))
-            _connection.close()
+            engine.release(_connection)
 
 
 
@@ -94,6 +264,7 @@ class _DbCtx(threading.local):
     def __init__(self):
         self.connection = None
         self.transactions = 0
+        self.after_commit = []
 
     def is_init(self):
         """
@@ -109,6 +280,7 @@ class _DbCtx(threading.local):
         """
         self.connection = _LasyConnection()
         self.transactions = 0
+        self.after_commit = []
 
     def cleanup(self):
         """
@@ -118,12 +290,13 @@ class _DbCtx(threading.local):
         self.connection.cleanup()
         self.connection = None
 
-    def cursor(self):
+    def cursor(self, cursorclass=None):
         """
         获取cursor对象， 真正取得数据库连接
+        :param cursorclass: 游标类型，为None时使用连接默认的游标
         :return:
         """
-        return self.connection.cursor()
+        return self.connection.cursor(cursorclass)
 
 _db_ctx = _DbCtx()
 
@@ -180,8 +353,11 @@ class _TransactionCtx(object):
         _db_ctx.transactions = _db_ctx.transactions - 1
         try:
             if _db_ctx.transactions==0:
+                callbacks, _db_ctx.after_commit = _db_ctx.after_commit, []
                 if exctype is None:
                     self.commit()
+                    for func in callbacks:
+                        func()
                 else:
                     self.rollback()
         finally:
@@ -208,8 +384,8 @@ class Dict(dict):
     """
     def __init__(self, names = (), values = (), **kw):
         super(Dict, self).__init__(**kw)
-        for k, v in zip(names, values):
-            self[k] = v
+        if names:
+            self.update(zip(names, values))
 
     def __getattr__(self, key):
         try:
@@ -226,6 +402,9 @@ class DBError(Exception):
 class MultiColumnsError(DBError):
     pass
 
+class PoolTimeoutError(DBError):
+    pass
+
 def connection():
     """
     db模块核心函数，用于获取一个数据库连接
@@ -262,6 +441,23 @@ def transaction():
     """
     return _TransactionCtx()
 
+def after_commit(func):
+    """
+    在当前线程的事务提交后调用 func，事务回滚时不调用；不在事务中时立即调用
+    （不在事务中时每条SQL执行后自动提交）
+    用于删除缓存等需要在数据提交后才能做的事情，避免其他线程在提交前读到旧数据并重新写入缓存:
+        with db.transaction():
+            db.update('update blogs set name=? where id=?', name, blog_id)
+            db.after_commit(lambda: cache.delete(blog_id))
+    :param func: 不带参数的函数
+    :return:
+    """
+    global _db_ctx
+    if _db_ctx.transactions > 0:
+        _db_ctx.after_commit.append(func)
+    else:
+        func()
+
 def next_id(t = None):
     """
     生成一个唯一id   由 当前时间 + 随机数（由伪随机数得来）拼接得到
@@ -283,15 +479,21 @@ def _profiling(start, sql = ''):
     if t > 0.1:
         logging.warning('[PROFILING] [DB] %s: %s' % (t, sql))
 
-def create_engine(user, password, database, host = '127.0.0.1', port = 3306, **kw):
+def create_engine(user, password, database, host = '127.0.0.1', port = 3306,
+                  pool_size = 5, max_overflow = 10, pool_timeout = 30, recycle = 3600, pre_ping = True, **kw):
     """
     db模型的核心函数，用于连接数据库, 生成全局对象engine，
-    engine对象持有数据库连接
+    engine对象持有数据库连接池
     :param user:
     :param password:
     :param database:
     :param host:
     :param port:
+    :param pool_size: 连接池保留的空闲连接数，为0时不使用连接池
+    :param max_overflow: 连接池满时允许额外创建的连接数
+    :param pool_timeout: 连接全部借出时，等待空闲连接的秒数
+    :param recycle: 连接的最长存活秒数，超过后重建连接
+    :param pre_ping: 借出连接前是否先 ping 一次
     :param kw:
     :return:
     """
@@ -304,9 +506,23 @@ def create_engine(user, password, database, host = '127.0.0.1', port = 3306, **k
     for k , v in defaults.iteritems():                      # iteritems 同时迭代
         params[k] = kw.pop(k, v)                            # 删除kw 将其数据保存到params
     params.update(kw)                                       # 将kw 字典加到params 字典前
-    engine = _Engine(lambda: MySQLdb.connect(**params))
+    connect = lambda: MySQLdb.connect(**params)
+    pool = None
+    if pool_size > 0:
+        pool = _ConnectionPool(connect, pool_size, max_overflow, pool_timeout, recycle, pre_ping)
+    engine = _Engine(connect, pool)
     logging.info('Init mysql engine <%s> ok.' % hex(id(engine)))      # hex 转换对象为16进制
 
+def pool_stats():
+    """
+    返回连接池的统计信息：连接数、借出数、空闲数、等待次数和等待时间等
+    未使用连接池时返回None
+    :return:
+    """
+    if engine is None or engine.pool is None:
+        return None
+    return engine.pool.stats()
+
 
 
 def with_connection(func):                                  # 自定义装饰器
@@ -321,6 +537,77 @@ def with_connection(func):                                  # 自定义装饰器
             return func(*args, **kw)
     return _wrapper
 
+class _Statement(object):
+    """
+    编译后的SQL语句
+    sql: 将 ? 占位符替换成 %s 之后，可以直接交给驱动执行的SQL
+    nargs: 占位符的个数，用于检查参数个数
+    columns: 语句第一次执行后，保存结果集的列名，之后直接复用
+    """
+    __slots__ = ('source', 'sql', 'nargs', 'columns')
+
+    def __init__(self, sql):
+        self.source = sql
+        self.sql = sql.replace('?', '%s')            # str.replace(old, new, max) 替换不超过max次
+        self.nargs = sql.count('?')
+        self.columns = None
+
+    def check_args(self, args):
+        if len(args) != self.nargs:
+            raise DBError('Expect %d arguments but got %d: %s' % (self.nargs, len(args), self.sql))
+
+    def names(self, description):
+        """
+        返回结果集的列名，表结构变化导致列数不同时重新生成
+        :param description: cursor.description
+        :return:
+        """
+        names = self.columns
+        if names is None or len(names) != len(description):
+            names = self.columns = tuple([x[0] for x in description])
+        return names
+
+    def __str__(self):
+        return self.source
+
+    __repr__ = __str__
+
+# 以原始SQL为key 缓存编译后的语句，每条SQL执行前都要查一次，命中率接近100%，
+# 使用命中不加锁的 ClockCache
+_statements = cache.ClockCache(maxsize=256, name='db.statements')
+
+def _compile(sql):
+    """
+    编译SQL，优先从缓存中取得，已经编译过的语句直接返回
+    :param sql: SQL字符串 或者 prepare() 返回的语句对象
+    :return: _Statement
+    """
+    if sql.__class__ is _Statement:
+        return sql
+    st = _statements.get(sql)
+    if st is None:
+        st = _Statement(sql)
+        _statements.set(sql, st)
+    return st
+
+def prepare(sql):
+    """
+    预编译SQL，返回的语句对象可以代替SQL字符串传给 select/update 等函数，
+    不再经过语句缓存，适合在模块或类定义时生成的固定语句
+        _GET_USER = db.prepare('select * from user where id=?')
+        db.select_one(_GET_USER, 123)
+    :param sql:
+    :return:
+    """
+    return _Statement(sql)
+
+def statement_cache_stats():
+    """
+    返回SQL语句缓存的统计信息：命中、未命中、淘汰次数等
+    :return:
+    """
+    return _statements.stats()
+
 @with_connection
 def _select(sql, first, *args):
     """
@@ -332,13 +619,14 @@ def _select(sql, first, *args):
     """
     global _db_ctx
     cursor = None                                       # cursor获得python执行Mysql命令的方法,也就是我们所说的操作游标
-    sql = sql.replace('?', '%s')                       # str.replace(old, new, max) 替换不超过max次
-    logging.info('SQL: %s, ARGS: %s' % (sql, args))
+    st = _compile(sql)
+    st.check_args(args)
+    logging.info('SQL: %s, ARGS: %s', st.sql, args)
     try:
         cursor = _db_ctx.connection.cursor()
-        cursor.execute(sql, args)
+        cursor.execute(st.sql, args)
         if cursor.description:
-            name = [x[0] for x in cursor.description]
+            name = st.names(cursor.description)
         if first:
             values = cursor.fetchone()
             if not values:
@@ -384,6 +672,60 @@ def select(sql, *args):
     """
     return _select(sql, False, *args)
 
+def iter_select(sql, *args, **kw):
+    """
+    执行sql 以生成器形式逐行返回结果，适合遍历大表
+    使用服务端游标(SSCursor)，每次从服务器取 batch_size 行，内存占用与表的大小无关
+    生成器单独从连接池借出一个连接，迭代完或者被关闭时归还，
+    因此迭代期间当前线程仍然可以执行其他SQL；
+    该连接不参与当前线程的事务，读不到事务中尚未提交的修改
+        for comment in db.iter_select('select * from comments', batch_size=500):
+            ...
+    :param sql:
+    :param args:
+    :param kw: batch_size 每批读取的行数，默认100
+    :return: 生成器
+    """
+    batch_size = kw.pop('batch_size', 100)
+    if kw:
+        raise TypeError('Unexpected keyword arguments: %s' % ', '.join(kw))
+    st = _compile(sql)
+    st.check_args(args)
+    return _iter_select(st, args, batch_size)
+
+def _iter_select(st, args, batch_size):
+    """
+    iter_select 的生成器实现，第一次迭代时才获取连接，迭代结束或生成器关闭时释放连接
+    服务端游标在读完之前会独占连接，所以不使用当前线程的连接（_db_ctx），
+    而是单独借出一个连接，否则同一线程上的其他查询会报 "commands out of sync"
+    :param st: _Statement
+    :param args:
+    :param batch_size:
+    :return:
+    """
+    from MySQLdb.cursors import SSCursor
+    _connection = engine.connect()
+    cursor = None
+    logging.info('SQL: %s, ARGS: %s', st.sql, args)
+    try:
+        cursor = _connection.cursor(SSCursor)
+        cursor.execute(st.sql, args)
+        if not cursor.description:
+            return
+        name = st.names(cursor.description)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for values in rows:
+                yield Dict(name, values)
+    finally:
+        try:
+            if cursor:
+                cursor.close()
+        finally:
+            engine.release(_connection)
+
 
 @with_connection
 def _update(sql, *args):
@@ -395,11 +737,12 @@ def _update(sql, *args):
     """
     global _db_ctx
     cursor = None
-    sql = sql.replace('?' , '%s' )
-    logging.info('SQL: %s, ARGS: %s' % (sql, args))
+    st = _compile(sql)
+    st.check_args(args)
+    logging.info('SQL: %s, ARGS: %s', st.sql, args)
     try:
         cursor = _db_ctx.connection.cursor()
-        cursor.execute(sql, args)
+        cursor.execute(st.sql, args)
         r = cursor.rowcount
         if _db_ctx.transactions == 0:
             logging.info('auto commit')
@@ -429,6 +772,74 @@ def insert(table, **kw):
     sql = 'insert into `%s` (%s) values (%s)' % (table, ','.join(['`%s`' % col for col in cols]), ','.join(['?' for i in range(len(cols))]))
     return _update(sql, *args)
 
+@with_connection
+def _update_many(sql, seq_args):
+    """
+    使用 executemany 批量执行同一条语句，返回影响的行数
+    不在事务中时，整批只提交一次
+    :param sql:
+    :param seq_args: 参数元组组成的列表
+    :return:
+    """
+    global _db_ctx
+    cursor = None
+    st = _compile(sql)
+    for args in seq_args:
+        st.check_args(args)
+    logging.info('SQL: %s, ROWS: %s', st.sql, len(seq_args))
+    try:
+        cursor = _db_ctx.connection.cursor()
+        cursor.executemany(st.sql, seq_args)
+        r = cursor.rowcount
+        if _db_ctx.transactions == 0:
+            logging.info('auto commit')
+            _db_ctx.connection.commit()
+        return r
+    finally:
+        if cursor:
+            cursor.close()
+
+@with_connection
+def insert_many(table, rows, chunk_size=500):
+    """
+    批量执行insert语句
+    按列的集合对行分组，同一组的行使用同一条语句，每 chunk_size 行通过 executemany
+    合并成一条多行insert发送，不在事务中时每批提交一次
+        db.insert_many('user', [dict(id=1, name='Michael'), dict(id=2, name='Bob')])
+    :param table:
+    :param rows: 字典组成的列表，每个字典是一行
+    :param chunk_size: 每批的行数
+    :return: 插入的行数
+    """
+    groups = {}
+    order = []
+    for row in rows:
+        cols = tuple(sorted(row.iterkeys()))
+        if cols not in groups:
+            groups[cols] = []
+            order.append(cols)
+        groups[cols].append(tuple([row[col] for col in cols]))
+    r = 0
+    for cols in order:
+        sql = 'insert into `%s` (%s) values (%s)' % (table, ','.join(['`%s`' % col for col in cols]), ','.join(['?' for i in range(len(cols))]))
+        r = r + update_many(sql, groups[cols], chunk_size)
+    return r
+
+@with_connection
+def update_many(sql, seq_args, chunk_size=500):
+    """
+    批量执行同一条insert/update语句，每 chunk_size 组参数通过 executemany 发送一次，
+    不在事务中时每批提交一次
+    :param sql:
+    :param seq_args: 参数元组组成的列表
+    :param chunk_size: 每批的参数组数
+    :return: 影响的行数
+    """
+    r = 0
+    for i in range(0, len(seq_args), chunk_size):
+        r = r + _update_many(sql, seq_args[i:i + chunk_size])
+    return r
+
 
 def with_transaction(func):
     """
@@ -29,10 +29,15 @@ orm模块设计的原因：
 """
 
 import db
+import cache
+import uuid
 import logging
+import threading
+import functools
+from collections import OrderedDict
 
 
-_triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete'])
+_triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete', 'post_insert', 'post_update', 'post_delete'])
 
 ###########################
 #同set 但为不可变集合 不能修改 set能修改
@@ -102,6 +107,8 @@ class Field(object):
     self._default: 用于让orm自己填入缺省值，缺省值可以是 可调用对象，比如函数
                 比如：passwd 字段 <StringField:passwd,varchar(255),default(<function <lambda> at 0x0000000002A13898>),UI>
                      这里passwd的默认值 就可以通过 返回的函数 调用取得
+    self.defer: 为True时 find_first/find_all/find_by/iter_by 默认不查询该字段，
+                第一次访问时再单独查询，适合 TextField/BlobField 这类大字段
     其他的实例属性都是用来描述字段属性的
 
     """
@@ -113,9 +120,10 @@ class Field(object):
         self._default = kw.get('default', None)
         self.primary_key = kw.get('primary_key', False)
         self.nullable = kw.get('nullable', False)
-        self.updatable = kw.get('updatabla', True)
+        self.updatable = kw.get('updatable', True)
         self.insertable = kw.get('insertable', True)
         self.ddl = kw.get('ddl', '')
+        self.defer = kw.get('defer', False)
         self._order = Field._count
         Field._count += 1
 
@@ -220,6 +228,38 @@ class VersionField(Field):
     def __init__(self, name=None):
         super(VersionField, self).__init__(name=name, default=0, ddl='bigint')
 
+def _gen_statements(table_name, mappings, primary_key, attrs):
+    """
+    类创建时预先生成 insert/update/delete/get 使用的字段列表和SQL，
+    SQL通过 db.prepare 预编译，实例方法只需要按顺序收集参数
+        "__insert_fields__": 可插入的字段 ((属性名, 字段对象), ...)，按定义顺序排列
+        "__update_fields__": 可更新的字段，格式同上
+        "__insert_sql__": insert into `table` (`a`,`b`) values (?,?)
+        "__update_sql__": update `table` set `a`=?,`b`=? where `pk`=?，没有可更新字段时为None
+        "__delete_sql__": delete from `table` where `pk`=?
+        "__get_sql__": select * from `table` where `pk`=?
+    :param table_name:
+    :param mappings:
+    :param primary_key:
+    :param attrs: 类属性字典，生成的结果保存在其中
+    :return:
+    """
+    fields = sorted(mappings.iteritems(), key=lambda kv: kv[1]._order)
+    insert_fields = tuple([(k, f) for k, f in fields if f.insertable])
+    update_fields = tuple([(k, f) for k, f in fields if f.updatable])
+    pk = primary_key.name
+    attrs['__insert_fields__'] = insert_fields
+    attrs['__update_fields__'] = update_fields
+    attrs['__insert_sql__'] = db.prepare('insert into `%s` (%s) values (%s)' % (table_name, ','.join(['`%s`' % f.name for k, f in insert_fields]), ','.join(['?'] * len(insert_fields))))
+    attrs['__update_sql__'] = db.prepare('update `%s` set %s where `%s`=?' % (table_name, ','.join(['`%s`=?' % f.name for k, f in update_fields]), pk)) if update_fields else None
+    attrs['__delete_sql__'] = db.prepare('delete from `%s` where `%s`=?' % (table_name, pk))
+    attrs['__get_sql__'] = db.prepare('select * from `%s` where `%s`=?' % (table_name, pk))
+    attrs['__partial_update_sql__'] = {}        # 只更新部分列时使用的SQL，按列名元组缓存
+    attrs['__projections__'] = {}               # 只查询部分列时使用的SQL前缀，见 Model._projection
+    attrs['__get_many_sql__'] = {}              # 按主键批量查询的SQL，按主键个数缓存
+    attrs['__cache_prefix__'] = 'orm:%s:' % table_name     # 二级缓存的key前缀
+    attrs['__deferred__'] = tuple([k for k, f in fields if f.defer])
+
 class ModelMetaclass(type):
     """
     使用metaclass 元素控制类的创建行为
@@ -283,11 +323,99 @@ class ModelMetaclass(type):
         attrs['__mappings__'] = mappings            # 保存属性和列的映射关系
         attrs['__primary_key__'] = primary_key
         attrs['__sql__'] = lambda self: _gen_sql(attrs['__table__'], mappings)
+        attrs['__select__'] = 'select * from `%s`' % attrs['__table__']     # 查询语句的公共部分，只生成一次
+        _gen_statements(attrs['__table__'], mappings, primary_key, attrs)
         for trigger in _triggers:
             if not trigger in attrs:
                 attrs[trigger] =None
         return type.__new__(cls, name, bases, attrs)
 
+class _IdentityMap(threading.local):
+    """
+    一级缓存（identity map），保存当前线程按主键加载过的实例，
+    同一个请求里多次 get 同一个主键时只查询一次数据库，并且得到同一个实例
+    默认不启用，由web模块在每个请求开始时调用 begin()，在请求结束时调用 clear()，
+    因此缓存的生命周期和 web.ctx 中的request相同，不会跨请求读到旧数据
+    该对象是一个 Thread local对象，因此绑定在此对象上的数据 仅对本线程可见
+    """
+    def __init__(self):
+        self.enabled = False
+        self.objects = {}
+
+    def begin(self):
+        self.enabled = True
+        self.objects = {}
+
+    def clear(self):
+        self.enabled = False
+        self.objects = {}
+
+    def get(self, cls, pk):
+        if not self.enabled:
+            return None
+        return self.objects.get((cls, pk))
+
+    def add(self, obj):
+        if self.enabled:
+            self.objects[(obj.__class__, obj[obj.__primary_key__.name])] = obj
+
+    def discard(self, cls, pk):
+        if self.enabled:
+            self.objects.pop((cls, pk), None)
+
+identity_map = _IdentityMap()
+
+# 二级缓存，在进程或者多个进程之间共享，只缓存设置了 __cache__ 的Model，
+# 默认使用进程内的LRU缓存，可以通过 set_cache 换成 cache.MemcacheCache
+_row_cache = cache.LRUCache(maxsize=10000, name='orm.rows')
+
+def set_cache(backend):
+    """
+    设置 Model.get 使用的二级缓存，backend 需要实现 get/get_many/set/delete
+    进程内缓存的失效只对当前进程生效，pre-fork 多进程部署时必须使用共享的缓存，否则应设为None 关闭二级缓存
+    :param backend: 为None时不使用二级缓存
+    :return:
+    """
+    global _row_cache
+    _row_cache = backend
+
+# 每行缓存有一个版本，保存在 key + _VERSION 中，删除缓存时更新
+_VERSION = ':v'
+
+def _versions(keys):
+    """
+    读取缓存行的版本，从数据库读取之前调用，没有版本的行为None
+    :param keys:
+    :return: key => 版本
+    """
+    r = _row_cache.get_many([key + _VERSION for key in keys])
+    return dict((key, r.get(key + _VERSION)) for key in keys)
+
+def _fill(rows, versions, ttl):
+    """
+    把从数据库读到的行写入缓存，版本与读之前不同的行不写入：
+    版本变化说明读的过程中有其他线程提交了修改并删除了缓存，读到的可能是旧数据
+    :param rows: key => 行的字典
+    :param versions: _versions 的返回值
+    :param ttl:
+    :return:
+    """
+    if not rows:
+        return
+    current = _versions(rows.keys())
+    for key, d in rows.iteritems():
+        if current[key] == versions[key]:
+            _row_cache.set(key, d, ttl)
+
+def _invalidate_row(key):
+    """
+    先更新版本再删除缓存，正在读数据库的线程不会再把旧数据写回缓存
+    :param key:
+    :return:
+    """
+    _row_cache.set(key + _VERSION, uuid.uuid4().hex[:8], ttl=0)
+    _row_cache.delete(key)
+
 class Model(dict):
     """
         这是一个基类，用户在子类中 定义映射关系， 因此我们需要动态扫描子类属性 ，
@@ -297,90 +425,292 @@ class Model(dict):
         "__mappings__": 字段对象(字段的所有属性，见Field类)
         "__primary_key__": 主键字段
         "__sql__": 创建表时执行的sql
+        "__select__": 查询语句的公共部分 select * from `table`
+        "__insert_sql__" 等: 预先生成的SQL，见 _gen_statements
+    子类可以通过 __cache__ 开启二级缓存，Model.get/get_many 先读缓存，insert/update/delete 在事务提交后删除缓存:
+        class User(Model):
+            __cache__ = dict(ttl=60)
     子类在实例化时，需要完成 实例属性 <==> 行值 的映射， 这里使用 定制dict 来实现。
         Model 从字典继承而来，并且通过"__getattr__","__setattr__"将Model重写，
         使得其像javascript中的 object对象那样，可以通过属性访问 值比如 a.key = value
 
     """
     __metaclass__ = ModelMetaclass              # 指定使用ModelMetaclass来制定类
+    __cache__ = None
 
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
 
+    def __setattr__(self, key, value):
+        """
+        set时生效，比如 a[key] = value, a = {'key1': value1, 'key2': value2}
+        set时添加属性
+        :param key:
+        :param value:
+        :return:
+        """
+        self[key] = value
+
     def __getattr__(self, key):
         """
-        get时生效，比如 a[key],  a.get(key)
-        get时 返回属性的值
+        get时生效，比如 a.key
+        get时 返回属性的值，延迟加载的字段在第一次访问时查询
         :param key:
         :return:
         """
         try:
             return self[key]
         except KeyError:
+            deferred = self.__dict__.get('_deferred')
+            if deferred and key in deferred:
+                self._load_deferred()
+                return self[key]
             raise AttributeError(r"'Dict' object has no attribute '%s'" % key)  # r无需转义
 
-    def __setattr__(self, key, value):
+    @classmethod
+    def _load(cls, d, deferred=None):
         """
-        set时生效，比如 a[key] = value, a = {'key1': value1, 'key2': value2}
-        set时添加属性
-        :param key:
-        :param value:
+        用查询得到的一行数据创建实例，并保存这一行作为快照，
+        update() 通过比较快照只更新修改过的列
+        :param d: db.Dict
+        :param deferred: 没有查询、需要延迟加载的字段
         :return:
         """
-        self[key] = value
+        obj = cls(**d)
+        obj.__dict__['_snapshot'] = d
+        if deferred:
+            obj.__dict__['_deferred'] = deferred
+        return obj
+
+    def _load_deferred(self):
+        """
+        用一次查询加载所有延迟加载的字段，同时更新快照
+        :return:
+        """
+        deferred = self.__dict__.pop('_deferred')
+        names = [self.__mappings__[k].name for k in deferred]
+        pk = self.__primary_key__.name
+        d = db.select_one('select %s from `%s` where `%s`=?' % (','.join(['`%s`' % name for name in names]), self.__table__, pk), self[pk])
+        if d is None:
+            raise AttributeError('Cannot load deferred fields %s: row not found.' % ','.join(deferred))
+        for k, name in zip(deferred, names):
+            self[k] = d[name]
+        snapshot = self.__dict__.get('_snapshot')
+        if snapshot is not None:
+            snapshot.update(d)
+
+    @classmethod
+    def _projection(cls, columns=None, defer=None):
+        """
+        返回查询语句的 select 部分，以及没有查询的字段
+            columns: 只查询这些字段，主键总是会被查询
+            defer: 不查询这些字段
+        都为None时使用字段定义中的 defer 选项
+        :param columns:
+        :param defer:
+        :return: (sql前缀, 延迟加载的字段)
+        """
+        if columns is None and defer is None:
+            defer = cls.__deferred__
+            if not defer:
+                return cls.__select__, ()
+        key = (tuple(columns) if columns is not None else None, tuple(defer or ()))
+        r = cls.__projections__.get(key)
+        if r is None:
+            pk = cls.__primary_key__.name
+            keys = set(columns) if columns is not None else set(cls.__mappings__)
+            keys.difference_update(defer or ())
+            keys.add(pk)
+            for k in keys:
+                if k not in cls.__mappings__:
+                    raise AttributeError('No such field: %s' % k)
+            selected = []
+            deferred = []
+            for k, f in sorted(cls.__mappings__.iteritems(), key=lambda kv: kv[1]._order):
+                if k in keys:
+                    selected.append('`%s`' % f.name)
+                else:
+                    deferred.append(k)
+            r = ('select %s from `%s`' % (','.join(selected), cls.__table__), tuple(deferred))
+            cls.__projections__[key] = r
+        return r
+
+    def _take_snapshot(self):
+        self.__dict__['_snapshot'] = dict(self)
 
     @classmethod                                        # 类方法
     def get(cls, pk):
         """
         获取主键
+        启用了 identity_map 时优先返回本次请求中已经加载过的实例
         :param pk:
         :return:
         """
-        d = db.select_one('select * from %s where %s=?' % (cls.__table__, cls.__primary_key__.name). pk)
-        return cls(**d) if d else None
+        obj = identity_map.get(cls, pk)
+        if obj is not None:
+            return obj
+        cached = cls.__cache__ and _row_cache is not None
+        if cached:
+            key = cls._cache_key(pk)
+            d = _row_cache.get(key)
+            if d is not None:
+                obj = cls._load(db.Dict(**d))
+                identity_map.add(obj)
+                return obj
+            versions = _versions([key])
+        d = db.select_one(cls.__get_sql__, pk)
+        if not d:
+            return None
+        if cached:
+            _fill({key: dict(d)}, versions, cls.__cache__.get('ttl'))
+        obj = cls._load(d)
+        identity_map.add(obj)
+        return obj
+
+    @classmethod
+    def _cache_key(cls, pk):
+        key = '%s%s' % (cls.__cache_prefix__, pk)
+        return key.encode('utf-8') if isinstance(key, unicode) else key
+
+    def _invalidate(self):
+        """
+        删除二级缓存中的这一行，在事务中时等到事务提交后再删除
+        :return:
+        """
+        if self.__cache__ and _row_cache is not None:
+            db.after_commit(functools.partial(_invalidate_row, self._cache_key(self[self.__primary_key__.name])))
+
+    @classmethod
+    def get_many(cls, pks, chunk_size=100):
+        """
+        按主键批量查询，每 chunk_size 个主键执行一次 where pk in (...) 查询
+        重复的主键只查询一次，不存在的主键不出现在结果中
+        启用了 identity_map 时，本次请求中已经加载过的主键不再查询，
+        开启了二级缓存时，先批量读取缓存
+            Blog.get_many(['1', '2', '1'])
+            # => OrderedDict([('1', <Blog>), ('2', <Blog>)])
+        :param pks:
+        :param chunk_size:
+        :return: 以主键为key的 OrderedDict，顺序与传入的主键一致
+        """
+        pks = list(pks)
+        found = {}
+        missing = []
+        for pk in pks:
+            if pk not in found:
+                obj = identity_map.get(cls, pk)
+                found[pk] = obj
+                if obj is None:
+                    missing.append(pk)
+        cached = cls.__cache__ and _row_cache is not None
+        if missing and cached:
+            keys = dict((cls._cache_key(pk), pk) for pk in missing)
+            for key, d in _row_cache.get_many(keys.keys()).iteritems():
+                obj = cls._load(db.Dict(**d))
+                identity_map.add(obj)
+                found[keys[key]] = obj
+            missing = [pk for pk in missing if found[pk] is None]
+        name = cls.__primary_key__.name
+        for i in range(0, len(missing), chunk_size):
+            chunk = missing[i:i + chunk_size]
+            if cached:
+                versions = _versions([cls._cache_key(pk) for pk in chunk])
+                rows = {}
+            for d in db.select(cls._get_many_sql(len(chunk)), *chunk):
+                if cached:
+                    rows[cls._cache_key(d[name])] = dict(d)
+                obj = cls._load(d)
+                identity_map.add(obj)
+                found[d[name]] = obj
+            if cached:
+                _fill(rows, versions, cls.__cache__.get('ttl'))
+        r = OrderedDict()
+        for pk in pks:
+            obj = found.get(pk)
+            if obj is not None:
+                r[pk] = obj
+        return r
+
+    @classmethod
+    def _get_many_sql(cls, n):
+        """
+        返回按n个主键批量查询的语句，按n缓存
+        :param n:
+        :return:
+        """
+        st = cls.__get_many_sql__.get(n)
+        if st is None:
+            st = db.prepare('%s where `%s` in (%s)' % (cls.__select__, cls.__primary_key__.name, ','.join(['?'] * n)))
+            cls.__get_many_sql__[n] = st
+        return st
 
     @classmethod
-    def find_first(cls, where, *args):
+    def find_first(cls, where, *args, **kw):
         """
         通过where语句进行条件查询，返回1个查询结果。如果有多个查询结果
         仅取第一个，如果没有结果，则返回None
         :param where:
         :param args:
+        :param kw: columns/defer 只查询部分字段，见 find_by
         :return:
         """
-        d = db.select_one('select * from %s %s ' % (cls.__table__, where), *args)
-        return cls(**d) if d else None
+        select, deferred = cls._projection(**kw)
+        d = db.select_one('%s %s' % (select, where), *args)
+        return cls._load(d, deferred) if d else None
 
     @classmethod
-    def find_all(cls, *args):
+    def find_all(cls, *args, **kw):
         """
         查询所有字段， 将结果以一个列表返回
         :param args:
+        :param kw: columns/defer 只查询部分字段，见 find_by
         :return:
         """
-        L = db.select('select * from `%s`' % cls.__table__)
-        return [cls(**d) for d in L]
+        select, deferred = cls._projection(**kw)
+        L = db.select(select)
+        return [cls._load(d, deferred) for d in L]
 
     @classmethod
-    def find_all_desc(cls, *args):
+    def find_all_desc(cls, *args, **kw):
         """
         查询所有字段， 将结果以一个列表返回
         :param args:
+        :param kw: columns/defer 只查询部分字段，见 find_by
         :return:
         """
-        L = db.select('select * from `%s` order by id desc' % cls.__table__)
-        return [cls(**d) for d in L]
+        select, deferred = cls._projection(**kw)
+        L = db.select('%s order by id desc' % select)
+        return [cls._load(d, deferred) for d in L]
 
     @classmethod
-    def find_by(cls, where, *args):
+    def find_by(cls, where, *args, **kw):
         """
         通过where语句进行条件查询，将结果以一个列表返回
+        可以只查询部分字段，没有查询的字段在第一次访问时用一次查询加载：
+            Blog.find_by('order by created_at desc limit ?,?', 0, 10, defer=('content',))
+            Blog.find_by('order by created_at desc limit ?,?', 0, 10, columns=('id', 'name', 'summary'))
+        :param where:
+        :param args:
+        :param kw: columns 只查询这些字段; defer 不查询这些字段
+        :return:
+        """
+        select, deferred = cls._projection(**kw)
+        L = db.select('%s %s' % (select, where), *args)
+        return [cls._load(d, deferred) for d in L]
+
+    @classmethod
+    def iter_by(cls, where, *args, **kw):
+        """
+        通过where语句进行条件查询，以生成器形式逐个返回实例，适合遍历大表
+        使用服务端游标，见 db.iter_select
         :param where:
         :param args:
+        :param kw: batch_size 每批读取的行数; columns/defer 只查询部分字段，见 find_by
         :return:
         """
-        L = db.select('select * from `%s` %s' % (cls.__table__, where), *args)
-        return [cls(**d) for d in L]
+        select, deferred = cls._projection(kw.pop('columns', None), kw.pop('defer', None))
+        L = db.iter_select('%s %s' % (select, where), *args, **kw)
+        return (cls._load(d, deferred) for d in L)
 
 
 
@@ -390,7 +720,7 @@ class Model(dict):
         执行 select count(pk) from table语句，返回一个数值
         :return:
         """
-        return db.select('select count(`%s`) from `%s`' % (cls.__primary_key__.name, cls.__table__))
+        return db.select_int('select count(`%s`) from `%s`' % (cls.__primary_key__.name, cls.__table__))
 
     @classmethod
     def count_by(cls, where, *arg):
@@ -398,7 +728,7 @@ class Model(dict):
         通过select count(pk) from table where ...语句进行查询， 返回一个数值
         :return:
         """
-        return db.select_int('sekect count(`%s`) from `%s` %s' % (cls.__primary_key__.name, cls.__table__, where), *arg)
+        return db.select_int('select count(`%s`) from `%s` %s' % (cls.__primary_key__.name, cls.__table__, where), *arg)
 
     def update(self):
         """
@@ -408,29 +738,78 @@ class Model(dict):
             如果有属性， 就使用用户传入的值
             如果无属性， 则调用字段对象的 default属性传入
             具体见 Field类 的 default 属性
-        通过的db对象的update接口执行SQL
-            SQL: update `user` set `passwd`=%s,`last_modified`=%s,`name`=%s where id=%s,
-                 ARGS: (u'******', 1441878476.202391, u'Michael', 10190
+        通过的db对象的update接口执行预先生成的update语句
+            SQL: update `user` set `name`=%s,`passwd`=%s,`last_modified`=%s where `id`=%s,
+                 ARGS: (u'Michael', u'******', 1441878476.202391, 10190)
+        从数据库读出或者插入过的实例保存有快照，只更新与快照相比修改过的列，
+        没有修改时不执行SQL:
+            SQL: update `user` set `name`=%s where `id`=%s, ARGS: (u'Bob', 10190)
 
         :return:
         """
         self.pre_update and self.pre_update()
-        L = []
-        args = []
-        for k, v in self.__mappings__.iteritems():
-            if v.updatable:
-                if hasattr(self, k):            # self 对象 含有属性 k吗 含有 返回True
-                    arg = getattr(self, k)      # 从self 对象获取属性 k  self.k
-                else:
-                    arg = v.default
-                    setattr(self, k , arg)
-                L.append('`%s`=?' % k)
-                args.append(arg)
-        pk = self.__primary_key__.name
-        args.append(getattr(self, pk))          # 从self 对象获取属性 pk  self.pk
-        db.update('updata `%s` set %s where %s=?' % (self.__table__, ','.join(L), pk),*args)
+        snapshot = self.__dict__.get('_snapshot')
+        if snapshot is None:
+            if self.__update_sql__ is not None:
+                db.update(self.__update_sql__, *self._update_args())
+        else:
+            names, args = self._dirty_args(snapshot)
+            if not names:
+                return self
+            args.append(self[self.__primary_key__.name])
+            db.update(self._partial_update_sql(names), *args)
+        self._invalidate()
+        self._take_snapshot()
+        identity_map.add(self)
+        self.post_update and self.post_update()
         return self
 
+    def _update_args(self):
+        """
+        按 __update_fields__ 的顺序收集参数，最后一个参数是主键的值
+        :return:
+        """
+        args = []
+        for k, v in self.__update_fields__:
+            if k in self:
+                arg = self[k]
+            else:
+                arg = v.default
+                self[k] = arg
+            args.append(arg)
+        args.append(self[self.__primary_key__.name])
+        return args
+
+    def _dirty_args(self, snapshot):
+        """
+        与快照比较，返回修改过的可更新列的列名元组和对应的值
+        实例中不存在的列不会被更新
+        :param snapshot:
+        :return:
+        """
+        names = []
+        args = []
+        for k, v in self.__update_fields__:
+            if k in self:
+                arg = self[k]
+                if k not in snapshot or arg != snapshot[k]:
+                    names.append(v.name)
+                    args.append(arg)
+        return tuple(names), args
+
+    @classmethod
+    def _partial_update_sql(cls, names):
+        """
+        返回只更新指定列的update语句，按列名元组缓存
+        :param names:
+        :return:
+        """
+        st = cls.__partial_update_sql__.get(names)
+        if st is None:
+            st = db.prepare('update `%s` set %s where `%s`=?' % (cls.__table__, ','.join(['`%s`=?' % name for name in names]), cls.__primary_key__.name))
+            cls.__partial_update_sql__[names] = st
+        return st
+
     def delete(self):
         """
          通过db对象的 update接口 执行SQL
@@ -438,28 +817,60 @@ class Model(dict):
         :return:
         """
         self.pre_delete and self.pre_delete()
-        pk = self.__primary_key__.name
-        args = (getattr(self, pk), )
-        db.update('delete from `%s` where `%s`=?' % (self.__table__, pk), *args)
+        pk = self[self.__primary_key__.name]
+        db.update(self.__delete_sql__, pk)
+        self._invalidate()
+        identity_map.discard(self.__class__, pk)
+        self.post_delete and self.post_delete()
         return self
 
     def insert(self):
         """
-        通过db对象的insert接口执行SQL
-            SQL: insert into `user` (`passwd`,`last_modified`,`id`,`name`,`email`) values (%s,%s,%s,%s,%s),
-            ARGS: ('******', 1441878476.202391, 10190, 'Michael', 'orm@db.org')
+        通过db对象的update接口执行预先生成的insert语句
+            SQL: insert into `user` (`id`,`name`,`email`,`passwd`,`last_modified`) values (%s,%s,%s,%s,%s),
+            ARGS: (10190, 'Michael', 'orm@db.org', '******', 1441878476.202391)
         :return:
         """
-        self.pre_insert and  self.pre_insert()
-        params = {}
-        for k, v in self.__mappings__.iteritems():
-            if v.insertable:
-                if not hasattr(self, k):
-                    setattr(self, k, v.default)
-                params[v.name] = getattr(self, k)
-        db.insert('%s' % self.__table__, **params)
+        db.update(self.__insert_sql__, *self._insert_args())
+        self._invalidate()
+        self._take_snapshot()
+        identity_map.add(self)
+        self.post_insert and self.post_insert()
         return self
 
+    def _insert_args(self):
+        """
+        执行 pre_insert 触发器，为缺少的字段填入缺省值，按 __insert_fields__ 的顺序收集参数
+        :return:
+        """
+        self.pre_insert and  self.pre_insert()
+        args = []
+        for k, v in self.__insert_fields__:
+            if k in self:
+                arg = self[k]
+            else:
+                arg = v.default
+                self[k] = arg
+            args.append(arg)
+        return args
+
+    @classmethod
+    def insert_many(cls, instances, chunk_size=500):
+        """
+        批量插入实例，通过db对象的update_many接口执行预先生成的insert语句
+        每个实例都会执行 pre_insert 触发器并填入缺省值，之后按批通过 executemany 发送，
+        全部插入后再执行每个实例的 post_insert 触发器
+        :param instances:
+        :param chunk_size: 每批的行数
+        :return: instances
+        """
+        db.update_many(cls.__insert_sql__, [obj._insert_args() for obj in instances], chunk_size)
+        for obj in instances:
+            obj._invalidate()
+            obj._take_snapshot()
+            obj.post_insert and obj.post_insert()
+        return instances
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     db.create_engine('root','123456', 'awesome','localhost')
@@ -0,0 +1,522 @@
+# -*- coding: utf-8 -*-
+"""
+server模块设计的原因：
+    wsgiref 自带的 WSGI Server 一次只能处理一个请求，也不支持 keep-alive，只适合开发调试
+    本模块提供一个可以用于生产环境的 HTTP/1.1 WSGI Server
+设计server接口：
+    1. 线程池
+        主线程负责 accept，连接放入队列，由固定数量的工作线程处理，
+        ctx、_db_ctx 都是 threading.local，应用不需要做任何修改
+    2. pre-fork
+        processes > 1 时，先创建监听socket，再fork出多个子进程，
+        每个子进程在同一个监听socket上 accept，各自运行一个线程池
+        数据库连接在第一次使用时才建立，fork 之前不要访问数据库
+    3. keep-alive
+        HTTP/1.1 默认保持连接，HTTP/1.0 需要请求头 Connection: keep-alive
+        响应没有 Content-Length 时，HTTP/1.1 使用 chunked 编码，HTTP/1.0 发送完后关闭连接
+    4. 平滑关闭
+        收到 SIGTERM 后停止 accept，正在处理的请求处理完后关闭连接，工作线程全部退出后进程结束
+    使用：
+        from transwarp.server import HTTPServer
+        HTTPServer(application, '0.0.0.0', 9000, threads=10, processes=4).serve_forever()
+"""
+
+import os
+import sys
+import errno
+import socket
+import signal
+import logging
+import threading
+import urllib
+import Queue
+
+from email.utils import formatdate
+
+_RESPONSE_STATUSES_NO_BODY = ('204', '304')
+
+_MAX_LINE = 65536
+_MAX_HEADERS = 100
+
+class FileWrapper(object):
+    """
+    wsgi.file_wrapper 的实现，按块读取文件
+    :param filelike:
+    :param blksize:
+    :return:
+    """
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+
+    def __iter__(self):
+        read, blksize = self.filelike.read, self.blksize
+        while True:
+            data = read(blksize)
+            if not data:
+                return
+            yield data
+
+
+class _Input(object):
+    """
+    wsgi.input，最多读取 Content-Length 个字节，保证不会读到同一连接上的下一个请求
+    """
+    def __init__(self, rfile, length):
+        self._rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size <= 0:
+            return ''
+        data = self._rfile.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size <= 0:
+            return ''
+        data = self._rfile.readline(size)
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(self)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+
+class _BadRequest(Exception):
+    pass
+
+
+class HTTPServer(object):
+    """
+    线程池 + 可选 pre-fork 的 WSGI Server
+    threads: 每个进程的工作线程数
+    processes: 进程数，大于1时使用 pre-fork
+    backlog: 监听socket的 accept 队列长度
+    keepalive_timeout: 保持连接时等待下一个请求的秒数，也是读取请求的超时时间
+    initializer: 每个处理请求的进程在启动工作线程之前调用 initializer(server)，
+                 用于创建进程池等不能在多线程的进程中 fork 的资源
+    """
+    def __init__(self, application, host='127.0.0.1', port=9000, threads=10, processes=1, backlog=128, keepalive_timeout=5, initializer=None):
+        self.application = application
+        self.host = host
+        self.port = port
+        self.threads = threads
+        self.processes = processes
+        self.backlog = backlog
+        self.keepalive_timeout = keepalive_timeout
+        self.initializer = initializer
+        self._socket = None
+        self._shutdown = threading.Event()
+        self._children = set()
+
+    def bind(self):
+        """
+        创建监听socket，pre-fork 时所有子进程共享这个socket
+        :return:
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        # 超时用于定期检查是否需要关闭，多个进程同时 accept 时也不会阻塞在已被取走的连接上
+        sock.settimeout(1.0)
+        self._socket = sock
+        self.port = sock.getsockname()[1]
+        return sock
+
+    def fileno(self):
+        """
+        返回监听socket的文件描述符
+        :return:
+        """
+        return self._socket.fileno()
+
+    def shutdown(self, *args):
+        """
+        停止 accept，等待正在处理的请求完成后退出，可以作为 SIGTERM 的处理函数
+        :return:
+        """
+        self._shutdown.set()
+
+    def serve_forever(self):
+        """
+        启动服务，直到收到 SIGTERM 或 KeyboardInterrupt
+        :return:
+        """
+        if self._socket is None:
+            self.bind()
+        logging.info('server started at %s:%s with %s process(es) x %s thread(s)' % (self.host, self.port, self.processes, self.threads))
+        if self.processes > 1:
+            self._serve_prefork()
+        else:
+            signal.signal(signal.SIGTERM, self.shutdown)
+            self._serve_threads()
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self._children.add(pid)
+            return
+        # 子进程
+        code = 0
+        try:
+            self._children.clear()
+            signal.signal(signal.SIGTERM, self.shutdown)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self._serve_threads()
+        except BaseException:
+            logging.exception('worker process %s failed' % os.getpid())
+            code = 1
+        finally:
+            os._exit(code)
+
+    def _serve_prefork(self):
+        """
+        主进程只负责启动子进程，子进程异常退出时重新启动，
+        收到 SIGTERM 后通知所有子进程平滑关闭，并等待它们退出
+        :return:
+        """
+        for i in range(self.processes):
+            self._spawn()
+        signal.signal(signal.SIGTERM, self.shutdown)
+        try:
+            while self._children:
+                if self._shutdown.is_set():
+                    break
+                try:
+                    pid, status = os.waitpid(-1, 0)
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                self._children.discard(pid)
+                if not self._shutdown.is_set():
+                    logging.warning('worker process %s exited with status %s, restarting' % (pid, status))
+                    self._spawn()
+        except KeyboardInterrupt:
+            self._shutdown.set()
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            self._children.discard(pid)
+        self._socket.close()
+        logging.info('server stopped')
+
+    def _serve_threads(self):
+        """
+        当前线程 accept，连接交给工作线程处理
+        队列满时 accept 暂停，新连接留在内核的 backlog 里
+        :return:
+        """
+        if self.initializer is not None:
+            self.initializer(self)
+        connections = Queue.Queue(self.threads * 2)
+        workers = []
+        for i in range(self.threads):
+            t = threading.Thread(target=self._worker, args=(connections,))
+            t.daemon = True
+            t.start()
+            workers.append(t)
+        try:
+            while not self._shutdown.is_set():
+                try:
+                    conn, addr = self._socket.accept()
+                except socket.timeout:
+                    continue
+                except socket.error, e:
+                    if e.args[0] in (errno.EINTR, errno.EAGAIN, errno.ECONNABORTED):
+                        continue
+                    raise
+                connections.put((conn, addr))
+        except KeyboardInterrupt:
+            self._shutdown.set()
+        logging.info('server shutting down, draining %s worker(s)...' % len(workers))
+        for t in workers:
+            connections.put(None)
+        for t in workers:
+            while t.is_alive():
+                t.join(1.0)
+        if self.processes <= 1:
+            self._socket.close()
+            logging.info('server stopped')
+
+    def _worker(self, connections):
+        while True:
+            item = connections.get()
+            if item is None:
+                return
+            conn, addr = item
+            try:
+                self._handle_connection(conn, addr)
+            except Exception, e:
+                logging.exception(e)
+            finally:
+                try:
+                    conn.close()
+                except socket.error:
+                    pass
+
+    def _handle_connection(self, conn, addr):
+        """
+        在一个连接上依次处理请求，直到不需要保持连接、超时或者服务关闭
+        :param conn:
+        :param addr:
+        :return:
+        """
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn.settimeout(self.keepalive_timeout)
+        rfile = conn.makefile('rb', -1)
+        try:
+            while True:
+                try:
+                    keep_alive = self._handle_request(conn, rfile, addr)
+                except socket.timeout:
+                    return
+                except socket.error, e:
+                    if e.args[0] not in (errno.EPIPE, errno.ECONNRESET):
+                        logging.warning('connection error from %s: %s' % (addr[0], e))
+                    return
+                if not keep_alive or self._shutdown.is_set():
+                    return
+        finally:
+            rfile.close()
+
+    def _read_headers(self, rfile):
+        headers = []
+        while True:
+            line = rfile.readline(_MAX_LINE + 1)
+            if len(line) > _MAX_LINE:
+                raise _BadRequest('header line too long')
+            if line in ('\r\n', '\n', ''):
+                return headers
+            if line[0] in ' \t' and headers:
+                name, value = headers[-1]
+                headers[-1] = (name, value + ' ' + line.strip())
+                continue
+            if ':' not in line:
+                raise _BadRequest('invalid header line')
+            name, value = line.split(':', 1)
+            headers.append((name.strip(), value.strip()))
+            if len(headers) > _MAX_HEADERS:
+                raise _BadRequest('too many headers')
+
+    def _environ(self, method, path, protocol, headers, rfile, addr):
+        path, _, query = path.partition('?')
+        if path.startswith('http://') or path.startswith('https://'):
+            path = '/' + path.split('/', 3)[-1] if path.count('/') >= 3 else '/'
+        env = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': protocol,
+            'REMOTE_ADDR': addr[0],
+            'REMOTE_PORT': str(addr[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': self.processes > 1,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': FileWrapper,
+        }
+        for name, value in headers:
+            key = name.upper().replace('-', '_')
+            if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                env[key] = value
+                continue
+            key = 'HTTP_' + key
+            if key in env:
+                env[key] = env[key] + ',' + value
+            else:
+                env[key] = value
+        try:
+            length = int(env.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            raise _BadRequest('invalid Content-Length')
+        if length < 0:
+            raise _BadRequest('invalid Content-Length')
+        env['wsgi.input'] = _Input(rfile, length)
+        return env
+
+    def _send_error(self, conn, status):
+        body = '<html><body><h1>%s</h1></body></html>' % status
+        conn.sendall('HTTP/1.1 %s\r\nContent-Type: text/html\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s' % (status, len(body), body))
+
+    def _handle_request(self, conn, rfile, addr):
+        """
+        处理一个请求，返回是否保持连接
+        :return:
+        """
+        line = rfile.readline(_MAX_LINE + 1)
+        if not line:
+            return False
+        if line in ('\r\n', '\n'):
+            # 允许请求之间多余的空行
+            line = rfile.readline(_MAX_LINE + 1)
+        try:
+            if len(line) > _MAX_LINE:
+                raise _BadRequest('request line too long')
+            parts = line.split()
+            if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+                raise _BadRequest('invalid request line')
+            method, path, protocol = parts
+            headers = self._read_headers(rfile)
+            env = self._environ(method, path, protocol, headers, rfile, addr)
+        except _BadRequest, e:
+            logging.warning('bad request from %s: %s' % (addr[0], e))
+            self._send_error(conn, '400 Bad Request')
+            return False
+        if 'chunked' in env.get('HTTP_TRANSFER_ENCODING', '').lower():
+            self._send_error(conn, '411 Length Required')
+            return False
+
+        connection = env.get('HTTP_CONNECTION', '').lower()
+        if protocol == 'HTTP/1.1':
+            keep_alive = 'close' not in connection
+        else:
+            keep_alive = 'keep-alive' in connection
+        if env.get('HTTP_EXPECT', '').lower() == '100-continue':
+            conn.sendall('HTTP/1.1 100 Continue\r\n\r\n')
+
+        response = _Response(conn, env, protocol, keep_alive)
+        try:
+            result = self.application(env, response.start_response)
+            try:
+                response.send(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception, e:
+            if response.headers_sent:
+                # 响应已经发送了一部分，只能关闭连接，客户端据此知道响应不完整
+                if isinstance(e, socket.error):
+                    raise
+                logging.exception(e)
+                return False
+            logging.exception(e)
+            self._send_error(conn, '500 Internal Server Error')
+            return False
+        # 应用没有读完的请求体需要读掉，否则会被当作下一个请求
+        body = env['wsgi.input']
+        if body.remaining > 0:
+            if body.remaining > 65536:
+                return False
+            body.read()
+        return response.keep_alive
+
+
+class _Response(object):
+    """
+    保存 start_response 传入的状态和响应头，发送第一块数据时才发送响应头
+    """
+    def __init__(self, conn, env, protocol, keep_alive):
+        self.conn = conn
+        self.env = env
+        self.protocol = protocol
+        self.keep_alive = keep_alive
+        self.status = None
+        self.headers = None
+        self.headers_sent = False
+        self.chunked = False
+        self.no_body = False
+
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info:
+            try:
+                if self.headers_sent:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+            finally:
+                exc_info = None
+        elif self.status is not None:
+            raise AssertionError('start_response() called twice')
+        self.status = status
+        self.headers = headers
+        return self.write
+
+    def _send_headers(self, content_length):
+        status = self.status
+        headers = list(self.headers)
+        names = set(name.lower() for name, value in headers)
+        self.no_body = self.env['REQUEST_METHOD'] == 'HEAD' or status[:3] in _RESPONSE_STATUSES_NO_BODY
+        if 'content-length' not in names and not self.no_body:
+            if content_length is not None:
+                headers.append(('Content-Length', str(content_length)))
+            elif self.protocol == 'HTTP/1.1':
+                self.chunked = True
+                headers.append(('Transfer-Encoding', 'chunked'))
+            else:
+                # HTTP/1.0 没有长度时只能通过关闭连接表示响应结束
+                self.keep_alive = False
+        if 'date' not in names:
+            headers.append(('Date', formatdate(usegmt=True)))
+        if 'server' not in names:
+            headers.append(('Server', 'transwarp'))
+        if self.keep_alive:
+            if self.protocol != 'HTTP/1.1':
+                headers.append(('Connection', 'keep-alive'))
+        else:
+            headers.append(('Connection', 'close'))
+        L = ['%s %s\r\n' % (self.protocol if self.protocol == 'HTTP/1.0' else 'HTTP/1.1', status)]
+        L.extend('%s: %s\r\n' % (name, value) for name, value in headers)
+        L.append('\r\n')
+        self.headers_sent = True
+        return ''.join(L)
+
+    def write(self, data):
+        if not self.headers_sent:
+            self.conn.sendall(self._send_headers(None))
+        if data and not self.no_body:
+            if self.chunked:
+                data = '%x\r\n%s\r\n' % (len(data), data)
+            self.conn.sendall(data)
+
+    def send(self, result):
+        """
+        发送应用返回的响应体
+        str 或者只有一项的 list 可以直接算出 Content-Length，不需要 chunked
+        :param result:
+        :return:
+        """
+        if self.status is None:
+            raise AssertionError('start_response() was not called')
+        if isinstance(result, str):
+            result = [result]
+        if isinstance(result, (list, tuple)) and not self.headers_sent:
+            body = ''.join(result)
+            headers = self._send_headers(len(body))
+            self.conn.sendall(headers if self.no_body else headers + body)
+            return
+        for data in result:
+            if data:
+                self.write(data)
+        if not self.headers_sent:
+            self.conn.sendall(self._send_headers(0))
+        if self.chunked:
+            self.conn.sendall('0\r\n\r\n')
@@ -32,8 +32,12 @@ WSGI概要：
     5. 事物数据：request数据和response数据的封装（thread local）
 
 """
-import types, os, re, cgi, sys, time, datetime, functools, mimetypes, threading, logging, traceback, urllib
+import types, os, re, cgi, sys, time, stat, datetime, functools, mimetypes, threading, logging, traceback, urllib, zlib, hashlib, uuid
+from email.utils import formatdate, parsedate_tz, mktime_tz
 import utils
+import db
+import orm
+import cache
 from db import Dict
 
 try:
@@ -298,6 +302,14 @@ class HttpError(object):
         """
         return _HttpError(403)
 
+    @staticmethod
+    def notmodified():
+        """
+        Send a not modified response.
+
+        """
+        return _HttpError(304)
+
     @staticmethod
     def notfound():
         """
@@ -511,10 +523,12 @@ class Request(object):
     @property
     def path_info(self):
         """
-        返回URL的path
+        返回URL的path，只解码一次
         :return:
         """
-        return urllib.unquote(self._environ.get('PATH_INFO', ''))
+        if not hasattr(self, '_path_info'):
+            self._path_info = urllib.unquote(self._environ.get('PATH_INFO', ''))
+        return self._path_info
 
     @property
     def host(self):
@@ -848,18 +862,138 @@ def _build_regex(path):
     re_list.append('$')
     return ''.join(re_list)
 
-def _static_file_generator(fpath, block_size=8192):
+def _static_file_generator(f, block_size=8192):
     """
-    读取静态文件的一个生成器
-    :param fpath:
+    读取静态文件的一个生成器，读完后关闭文件
+    :param f: 文件对象
     :param block_size:
     :return:
     """
-    with open(fpath, 'rb') as f:
+    try:
         block = f.read(block_size)
         while block:
             yield block
             block = f.read(block_size)
+    finally:
+        f.close()
+
+class _FileRange(object):
+    """
+    只读取文件中 [start, start+length) 的部分，用于Range请求
+    """
+    def __init__(self, f, start, length):
+        f.seek(start)
+        self._f = f
+        self._remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        if size <= 0:
+            return ''
+        data = self._f.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        self._f.close()
+
+_RE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def _parse_range(range_header, size):
+    """
+    解析单个Range，返回 (start, end)，end包含在内
+    多个Range 或者格式错误时返回None（按普通请求处理），范围无效时返回 False（416）
+    空文件没有可以返回的范围，返回None，按普通请求返回整个（空的）文件
+        'bytes=0-99'   => (0, 99)
+        'bytes=100-'   => (100, size-1)
+        'bytes=-100'   => (size-100, size-1)
+    :param range_header:
+    :param size:
+    :return:
+    """
+    m = _RE_RANGE.match(range_header.replace(' ', ''))
+    if not m or m.group(1) == m.group(2) == '' or size == 0:
+        return None
+    if m.group(1) == '':
+        length = int(m.group(2))
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(m.group(1))
+    end = int(m.group(2)) if m.group(2) else size - 1
+    if start > end or start >= size:
+        return False
+    return start, min(end, size - 1)
+
+class _StaticFile(object):
+    """
+    静态文件的stat信息和响应需要的header值
+    """
+    __slots__ = ('path', 'size', 'mtime', 'etag', 'content_type', 'checked')
+
+    def __init__(self, path, st, checked):
+        self.path = path
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.etag = '"%x-%x"' % (int(st.st_mtime), st.st_size)
+        fext = os.path.splitext(path[:-3] if path.endswith('.gz') else path)[1]
+        self.content_type = mimetypes.types_map.get(fext.lower(), 'application/octet-stream')
+        self.checked = checked
+
+class _StaticFiles(object):
+    """
+    静态文件的stat缓存，启动时扫描一次目录，请求时不再访问文件系统
+    check_interval: 条目超过这个秒数后重新stat，0 表示每次都stat（开发时修改文件立即生效）
+    不存在的文件也会缓存 check_interval 秒，避免404请求每次都访问文件系统，
+    保存在有大小限制的LRU缓存中，随意构造的路径不会让缓存无限增长
+    """
+    def __init__(self, root, check_interval=0, max_missing=10000):
+        self.root = os.path.abspath(root)
+        self.check_interval = check_interval
+        self._files = {}
+        self._missing = cache.LRUCache(max_missing, ttl=check_interval) if check_interval else None
+
+    def scan(self):
+        """
+        扫描目录，缓存所有文件的stat信息
+        :return:
+        """
+        now = time.time()
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    self._files[path] = _StaticFile(path, os.stat(path), now)
+                except OSError:
+                    pass
+        logging.info('Scan %d static files in %s' % (len(self._files), self.root))
+
+    def lookup(self, path):
+        """
+        返回文件的 _StaticFile，文件不存在时返回None
+        :param path: 绝对路径
+        :return:
+        """
+        now = time.time()
+        if self.check_interval:
+            f = self._files.get(path)
+            if f is not None and now - f.checked < self.check_interval:
+                return f
+            if f is None and self._missing.get(path):
+                return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        f = _StaticFile(path, st, now) if st and stat.S_ISREG(st.st_mode) else None
+        if self.check_interval:
+            if f is None:
+                self._files.pop(path, None)
+                self._missing.set(path, True)
+            else:
+                self._files[path] = f
+        return f
 
 class Route(object):
     """
@@ -896,7 +1030,7 @@ class Route(object):
         """
         m = self.route.match(url)
         if m:
-            return m.group()
+            return m.groups()
         return None
 
     def __call__(self, *args):
@@ -917,25 +1051,255 @@ class Route(object):
 class StaticFileRoute(object):
     """
      静态文件路由对象，和Route相对应
+     prefix: 匹配以该前缀开头的所有路径，由 _Router 注册为前缀路由
+     document_root: 静态文件目录的上一级目录，为None时使用 ctx.application.document_root
+     check_interval: 见 _StaticFiles，大于0时启动时扫描一次目录
+     cache_bytes: 大于0时把小文件的内容缓存在内存里，这是所有缓存内容的字节数上限，按LRU淘汰
+     cache_file_size: 不超过这个字节数的文件才缓存
+     缓存的内容随 _StaticFiles 按 check_interval 重新stat，mtime 或大小变化时重新读取
+     客户端接受gzip 且没有 .gz 文件时，缓存的文件同时缓存gzip压缩后的内容，
+     响应带上 Content-Encoding，压缩阶段不会再对每次请求重新压缩
+     支持：
+        1. ETag / Last-Modified 条件请求
+        2. 单个Range 请求，返回206
+        3. 客户端接受gzip 时，如果存在预先压缩的 .gz 文件，直接发送该文件
+        4. WSGI Server 提供 wsgi.file_wrapper 时使用它发送文件
     """
 
-    def __init__(self):
+    def __init__(self, document_root=None, prefix='/static/', check_interval=0, cache_bytes=0, cache_file_size=65536):
         self.method = 'GET'
         self.is_static = False
-        self.route = re.compile('^/static/(.+)$')
+        self.prefix = prefix
+        self.route = re.compile('^%s(.+)$' % re.escape(prefix))
+        self._files = None
+        self._cache = None
+        self._cache_file_size = cache_file_size
+        if cache_bytes:
+            self._cache = cache.LRUCache(maxsize=100000, name='web.static', maxbytes=cache_bytes)
+        if document_root:
+            self._files = _StaticFiles(os.path.join(document_root, prefix.strip('/')), check_interval)
+            if check_interval:
+                self._files.scan()
 
     def match(self, url):
-        if url.startswith('/static/'):      # startswith 匹配头 endswith匹配尾
+        if url.startswith(self.prefix):      # startswith 匹配头 endswith匹配尾
             return (url[1:],)
         return None
 
     def __call__(self, *args):
-        fpath = os.path.join(ctx.application.document_root, args[0])
-        if not os.path.isfile(fpath):
+        files = self._files
+        if files is None:
+            files = self._files = _StaticFiles(os.path.join(ctx.application.document_root, self.prefix.strip('/')))
+        fpath = os.path.normpath(os.path.join(os.path.dirname(files.root), args[0]))
+        if not fpath.startswith(files.root + os.sep):
+            raise HttpError.notfound()
+        f = files.lookup(fpath)
+        if f is None:
             raise HttpError.notfound()
-        fext = os.path.splitext(fpath)[1]
-        ctx.response.content_type = mimetypes.types_map.get(fext.lower(), 'application/octet-stream')
-        return _static_file_generator(fpath)
+        request, response = ctx.request, ctx.response
+        response.content_type = f.content_type
+        encoding = None
+        if not f.content_type.startswith(_INCOMPRESSIBLE_TYPES):
+            response.set_header('Vary', 'Accept-Encoding')
+            encoding = _accept_encoding(request.header('Accept-Encoding', ''))
+        gzip = encoding == 'gzip'
+        if gzip:
+            gz = files.lookup(fpath + '.gz')
+            if gz is not None:
+                f = gz
+                response.set_header('Content-Encoding', 'gzip')
+        body = None
+        if self._cache is not None and f.size <= self._cache_file_size:
+            if gzip and f.path == fpath:
+                body = self._cached_body(f, 'gzip')
+                if body is not None:
+                    response.set_header('Content-Encoding', 'gzip')
+            if body is None:
+                body = self._cached_body(f)
+        size = f.size if body is None else len(body)
+        etag = '%s-gzip"' % f.etag[:-1] if response.header('Content-Encoding') else f.etag
+        compress = ctx.application.compress
+        if compress is None or encoding is None or response.header('Content-Encoding') or size < compress['min_size']:
+            # 压缩阶段会即时压缩的响应不声明支持Range，Range 的偏移对应的是未压缩的内容
+            response.set_header('Accept-Ranges', 'bytes')
+        check_not_modified(etag, f.mtime)
+
+        start, length = 0, size
+        range_header = request.header('Range')
+        if range_header:
+            if_range = request.header('If-Range')
+            # If-Range 必须与当前表示的强ETag完全相同，即时压缩的响应的ETag（-gzip）对应不上未压缩的内容
+            if not if_range or (if_range == etag and not if_range.startswith('W/')):
+                r = _parse_range(range_header, size)
+                if r is False:
+                    response.set_header('Content-Range', 'bytes */%d' % size)
+                    raise _HttpError(416)
+                if r:
+                    start, length = r[0], r[1] - r[0] + 1
+                    response.status = 206
+                    response.set_header('Content-Range', 'bytes %d-%d/%d' % (r[0], r[1], size))
+        response.content_length = length
+        if body is not None:
+            return body[start:start + length] if length != size else body
+        try:
+            fp = open(f.path, 'rb')
+        except IOError:
+            raise HttpError.notfound()
+        if start or length != f.size:
+            fp = _FileRange(fp, start, length)
+        file_wrapper = request._environ.get('wsgi.file_wrapper')
+        if file_wrapper:
+            return file_wrapper(fp, 65536)
+        return _static_file_generator(fp)
+
+    def _cached_body(self, f, encoding=None):
+        """
+        返回缓存的文件内容，缓存的 mtime 和大小与 f 不一致时重新读取
+        缓存条目为 (mtime, 大小, 内容, gzip压缩后的内容)，压缩后的内容第一次需要时才生成，
+        压缩后没有变小时记为False，之后不再尝试
+        :param f: _StaticFile
+        :param encoding: 为 'gzip' 时返回压缩后的内容
+        :return: 文件内容，读取失败或者压缩后没有变小时返回None
+        """
+        entry = self._cache.get(f.path)
+        if entry is None or entry[0] != f.mtime or entry[1] != f.size:
+            try:
+                with open(f.path, 'rb') as fp:
+                    body = fp.read()
+            except IOError:
+                return None
+            if len(body) != f.size:
+                return None
+            entry = (f.mtime, f.size, body, None)
+            self._cache.set(f.path, entry, size=len(body))
+        if encoding != 'gzip':
+            return entry[2]
+        gz = entry[3]
+        if gz is None:
+            compressor = _compressobj('gzip', 9)
+            gz = compressor.compress(entry[2]) + compressor.flush()
+            if len(gz) >= f.size:
+                gz = False
+            self._cache.set(f.path, entry[:3] + (gz,), size=f.size + len(gz or ''))
+        return gz or None
+
+class _RouteNode(object):
+    """
+    路由前缀树的节点，对应路径中的一段
+        static: 静态段 => 子节点
+        dynamic: [(段的正则, 子节点), ...]，含变量的段，按注册顺序匹配
+        route: 路径在该节点结束时匹配的路由
+        prefix_routes: 匹配该节点之后任意剩余路径的路由，比如 StaticFileRoute
+    """
+    __slots__ = ('static', 'dynamic', 'route', 'prefix_routes')
+
+    def __init__(self):
+        self.static = {}
+        self.dynamic = []
+        self.route = None
+        self.prefix_routes = []
+
+class _Router(object):
+    """
+    启动时编译一次的路由表，代替逐个尝试动态路由的正则
+    每个 method 一张表：
+        完全静态的路径放在字典中，一次查找
+        含变量的路径按 '/' 分段放进前缀树，匹配时逐段查找，
+        静态段优先于动态段，匹配成功时同时得到路由和捕获的变量
+    HEAD 请求没有对应的路由时使用 GET 的路由
+    """
+    def __init__(self):
+        self._static = {}       # method => {path: route}
+        self._trees = {}        # method => _RouteNode
+        self._routes = []
+
+    def add(self, route):
+        """
+        添加一个路由
+        :param route: Route 或者带 prefix 属性的前缀路由
+        :return:
+        """
+        method = route.method
+        self._routes.append(route)
+        if route.is_static:
+            self._static.setdefault(method, {})[route.path] = route
+            return
+        node = self._trees.setdefault(method, _RouteNode())
+        prefix = getattr(route, 'prefix', None)
+        if prefix is not None:
+            for segment in prefix.strip('/').split('/'):
+                node = self._child(node, segment)
+            node.prefix_routes.append(route)
+            return
+        for segment in route.path.split('/')[1:]:
+            node = self._child(node, segment)
+        if node.route is None:
+            node.route = route
+
+    def _child(self, node, segment):
+        if _re_route.search(segment) is None:
+            child = node.static.get(segment)
+            if child is None:
+                child = node.static[segment] = _RouteNode()
+            return child
+        pattern = _build_regex(segment)
+        for regex, child in node.dynamic:
+            if regex.pattern == pattern:
+                return child
+        child = _RouteNode()
+        node.dynamic.append((re.compile(pattern), child))
+        return child
+
+    def _match_node(self, node, parts, i, args, path):
+        if i == len(parts):
+            if node.route is not None:
+                return node.route, args
+        else:
+            child = node.static.get(parts[i])
+            if child is not None:
+                r = self._match_node(child, parts, i + 1, args, path)
+                if r:
+                    return r
+            for regex, child in node.dynamic:
+                m = regex.match(parts[i])
+                if m:
+                    r = self._match_node(child, parts, i + 1, args + m.groups(), path)
+                    if r:
+                        return r
+            for route in node.prefix_routes:
+                prefix_args = route.match(path)
+                if prefix_args:
+                    return route, prefix_args
+        return None
+
+    def _match_method(self, method, path):
+        static = self._static.get(method)
+        if static:
+            route = static.get(path)
+            if route is not None:
+                return route, ()
+        tree = self._trees.get(method)
+        if tree is not None:
+            return self._match_node(tree, path.split('/')[1:], 0, (), path)
+        return None
+
+    def routes(self):
+        return self._routes[:]
+
+    def has_method(self, method):
+        return method in self._static or method in self._trees or (method == 'HEAD' and self.has_method('GET'))
+
+    def match(self, method, path):
+        """
+        查找路由
+        :param method:
+        :param path:
+        :return: (route, args)，没有匹配时返回None
+        """
+        r = self._match_method(method, path)
+        if r is None and method == 'HEAD':
+            r = self._match_method('GET', path)
+        return r
 
 #################################################################
 # 实现视图功能
@@ -963,19 +1327,102 @@ class TemplateEngine(object):
     def __call__(self, path, model):
         return '<!-- override this method to render template -->'
 
+_fragment_cache = cache.FragmentCache(ttl=300, name='web.fragments')
+
+def set_fragment_cache(fragment_cache):
+    """
+    替换模板片段缓存，比如多进程部署时使用带共享缓存的 cache.FragmentCache，
+    默认的进程内缓存只在当前进程失效，pre-fork 多进程部署时不使用共享缓存就应设为None
+    :param fragment_cache: 为None时 {% cache %} 每次都渲染片段
+    :return:
+    """
+    global _fragment_cache
+    _fragment_cache = fragment_cache
+
+def invalidate_fragments(prefix):
+    """
+    使key 以 prefix 开头的模板片段失效，比如发表评论后
+        invalidate_fragments('blog:%s:comments' % blog_id)
+    :param prefix:
+    :return:
+    """
+    if _fragment_cache is not None:
+        db.after_commit(functools.partial(_fragment_cache.invalidate, prefix))
+
+def _fragment_cache_extension():
+    """
+    返回实现 {% cache key, ttl %}...{% endcache %} 的jinja2扩展，ttl 可以省略：
+        {% cache 'blog:%s:comments' % blog.id, 60 %}
+            ...
+        {% endcache %}
+    片段渲染的结果保存在 _fragment_cache 中
+    :return:
+    """
+    from jinja2 import nodes, Markup
+    from jinja2.ext import Extension
+
+    class FragmentCacheExtension(Extension):
+        tags = set(['cache'])
+
+        def parse(self, parser):
+            lineno = next(parser.stream).lineno
+            args = [parser.parse_expression()]
+            if parser.stream.skip_if('comma'):
+                args.append(parser.parse_expression())
+            else:
+                args.append(nodes.Const(None))
+            body = parser.parse_statements(['name:endcache'], drop_needle=True)
+            return nodes.CallBlock(self.call_method('_cache', args), [], [], body).set_lineno(lineno)
+
+        def _cache(self, key, ttl, caller):
+            if _fragment_cache is None:
+                return caller()
+            value, gens = _fragment_cache.lookup(key)
+            if value is None:
+                value = caller()
+                _fragment_cache.set(key, unicode(value), ttl, gens)
+            return Markup(value)
+
+    return FragmentCacheExtension
+
 class Jinja2TemplateEngine(TemplateEngine):
     """
     渲染使用jinja2模板引擎
+    templ_dir: 模板目录
+    bytecode_cache_dir: 不为空时把编译后的模板保存在这个目录，进程重启后不需要重新编译
+    auto_reload: 为True时每次渲染都检查模板文件是否修改，生产环境应设为False
+    模板中可以使用 {% cache key, ttl %}...{% endcache %} 缓存片段，见 _fragment_cache_extension
     """
-    def __init__(self, templ_dir, **kw):
-        from jinja2 import Environment, FileSystemLoader
+    def __init__(self, templ_dir, bytecode_cache_dir=None, auto_reload=True, **kw):
+        from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
         if 'autoescape' not in kw:
             kw['autoescape'] = True
-        self._env = Environment(loader=FileSystemLoader(templ_dir), **kw)
+        if bytecode_cache_dir:
+            if not os.path.isdir(bytecode_cache_dir):
+                os.makedirs(bytecode_cache_dir)
+            kw['bytecode_cache'] = FileSystemBytecodeCache(bytecode_cache_dir)
+        kw['extensions'] = list(kw.get('extensions', ())) + [_fragment_cache_extension()]
+        self._env = Environment(loader=FileSystemLoader(templ_dir), auto_reload=auto_reload, **kw)
 
     def add_filter(self, name, fn_filter):
         self._env.filters[name] = fn_filter
 
+    def precompile(self):
+        """
+        加载并编译模板目录下的所有模板，在启动时（pre-fork 之前）调用，
+        这样第一个请求不需要解析和编译模板。需要在 add_filter 之后调用
+        :return: 编译的模板数量
+        """
+        n = 0
+        for name in self._env.list_templates():
+            try:
+                self._env.get_template(name)
+                n = n + 1
+            except Exception, e:
+                logging.warning('Failed to precompile template %s: %s' % (name, e))
+        logging.info('Precompiled %d templates.' % n)
+        return n
+
     def __call__(self, path, model):
         return self._env.get_template(path).render(**model).encode('utf-8')
 
@@ -1022,6 +1469,126 @@ def view(path):
     return _decorator
 
 
+#################################################################
+# 页面缓存
+# 缓存匿名用户GET 请求的最终页面（编码后的响应体和Content-Type），
+# 开启了压缩时按客户端接受的压缩方式分别缓存压缩后的响应体，命中时不再压缩
+# 页面按标签（tag）失效：每个标签有一个版本号，缓存的页面记录生成时各标签的版本号，
+# 任何一个标签的版本号变化后，页面不再命中
+# 标签的版本号单独保存，不会因为页面太多被淘汰
+#################################################################
+
+_page_cache = cache.LRUCache(1000, name='web.pages')
+_tag_cache = cache.LRUCache(100000, name='web.page_tags')
+
+def set_page_cache(backend, tags=None):
+    """
+    替换页面缓存的后端，比如多进程部署时使用 cache.MemcacheCache，
+    这样一个进程里的失效对所有进程生效，
+    默认的进程内缓存只在当前进程失效，pre-fork 多进程部署时不使用共享缓存就应设为None
+    :param backend: 保存页面，需要实现 get、set，为None时不缓存页面
+    :param tags: 保存标签的版本号，需要实现 get_many、set，为None时不替换
+    :return:
+    """
+    global _page_cache, _tag_cache
+    _page_cache = backend
+    if tags is not None:
+        _tag_cache = tags
+
+def _tag_versions(tags):
+    """
+    返回标签当前的版本号元组，不存在的标签生成一个新的版本号
+    :param tags:
+    :return:
+    """
+    keys = ['tag:%s' % t for t in tags]
+    versions = _tag_cache.get_many(keys)
+    r = []
+    for k in keys:
+        v = versions.get(k)
+        if v is None:
+            v = uuid.uuid4().hex
+            _tag_cache.set(k, v, ttl=0)
+        r.append(v)
+    return tuple(r)
+
+def _bump_tags(tags):
+    for t in tags:
+        _tag_cache.set('tag:%s' % t, uuid.uuid4().hex, ttl=0)
+
+def invalidate_tags(*tags):
+    """
+    使带有这些标签的缓存页面失效，比如写入博客后
+        invalidate_tags('blogs', 'blog:%s' % blog.id)
+    在事务中调用时，等事务提交后才失效，避免提交前的请求把旧页面重新写入缓存
+    :param tags:
+    :return:
+    """
+    if _page_cache is not None:
+        db.after_commit(functools.partial(_bump_tags, tags))
+
+def cached_view(ttl=60, vary=(), tags=(), cookie=None):
+    """
+    缓存页面，放在 @view 的外层：
+        @cached_view(ttl=60, tags=lambda blog_id: ('blog:%s' % blog_id,), cookie='awesession')
+        @view('blog.html')
+        @get('/blog/:blog_id')
+        def blog(blog_id):
+            ...
+    缓存的key 由 path、query string、vary 中的请求头和压缩方式组成
+    带有名为 cookie 的cookie（已登录用户）、非GET请求时不使用缓存
+    只缓存状态为200、没有设置cookie 的响应
+    应用开启了压缩时，缓存压缩后的响应体并设置 Content-Encoding，压缩阶段会跳过它
+    :param ttl: 过期秒数
+    :param vary: 需要加入key 的请求头名字
+    :param tags: 标签元组，或者接收处理函数参数、返回标签元组的函数
+    :param cookie: 会话cookie 的名字
+    :return:
+    """
+    def _decorator(func):
+        @functools.wraps(func)
+        def _wrapper(*args, **kw):
+            request, response = ctx.request, ctx.response
+            if _page_cache is None or request.request_method not in ('GET', 'HEAD') or (cookie and request.cookie(cookie)):
+                return func(*args, **kw)
+            compress = ctx.application.compress
+            encoding = _accept_encoding(request.header('Accept-Encoding', '')) if compress else None
+            key = 'page:%s?%s' % (request.path_info, request.query_string)
+            if vary:
+                key = '%s|%s' % (key, '|'.join(request.header(h, '') for h in vary))
+            key = '%s|%s' % (key, encoding or 'identity')
+            page_tags = tags(*args, **kw) if callable(tags) else tags
+            versions = _tag_versions(page_tags)
+            entry = _page_cache.get(key)
+            if entry is not None and entry[0] == versions:
+                versions, content_type, etag, body, content_encoding = entry
+                response.content_type = content_type
+                response.set_header('ETag', etag)
+                if content_encoding:
+                    _add_vary(response)
+                    response.set_header('Content-Encoding', content_encoding)
+                    response.content_length = len(body)
+                return body
+            r = func(*args, **kw)
+            if isinstance(r, Template):
+                r = ctx.application.template_engine(r.template_name, r.model)
+            if isinstance(r, unicode):
+                r = r.encode('utf-8')
+            if isinstance(r, str) and response.status_code == 200 and not hasattr(response, '_cookies'):
+                response.set_header('ETag', '"%s"' % hashlib.md5(r).hexdigest())
+                if encoding and _compressible(response) and len(r) >= compress['min_size']:
+                    compressor = _compressobj(encoding, compress['level'])
+                    r = compressor.compress(r) + compressor.flush()
+                    _add_vary(response)
+                    _set_encoding(response, encoding)
+                    response.content_length = len(r)
+                _page_cache.set(key, (versions, response.content_type, response.header('ETag'), r,
+                                      response.header('Content-Encoding')), ttl=ttl)
+            return r
+        return _wrapper
+    return _decorator
+
+
 #################################################################
 # 实现URL拦截器
 # 主要interceptor的实现
@@ -1030,22 +1597,35 @@ def view(path):
 _RE_INTERCEPTOR_STARTS_WITH = re.compile(r'^([^\*\?]+)\*?$')
 _RE_INTERCEPTOR_END_WITH = re.compile(r'^\*([^\*\?]+)$')
 
-def _build_pattern_fn(pattern):
+def _parse_pattern(pattern):
     """
-    传入需要匹配的字符串： URL
-    返回一个函数，该函数接收一个字符串参数，检测该字符串是否
-    符合pattern
+    解析拦截器的pattern
+        '/manage/' 或 '/manage/*'  => ('startswith', '/manage/')
+        '*.html'                   => ('endswith', '.html')
     :param pattern:
     :return:
     """
     m = _RE_INTERCEPTOR_STARTS_WITH.match(pattern)
     if m:
-        return lambda p: p.startswith(m.group(1))
+        return 'startswith', m.group(1)
     m = _RE_INTERCEPTOR_END_WITH.match(pattern)
     if m:
-        return lambda p: p.endswith(m.group(1))
+        return 'endswith', m.group(1)
     raise ValueError('Invalid pattern definition in interceptor.')
 
+def _build_pattern_fn(pattern):
+    """
+    传入需要匹配的字符串： URL
+    返回一个函数，该函数接收一个字符串参数，检测该字符串是否
+    符合pattern
+    :param pattern:
+    :return:
+    """
+    kind, s = _parse_pattern(pattern)
+    if kind == 'startswith':
+        return lambda p: p.startswith(s)
+    return lambda p: p.endswith(s)
+
 def interceptor(pattern='/'):
     """
     定义拦截器
@@ -1054,6 +1634,7 @@ def interceptor(pattern='/'):
     """
     def _decorator(func):
         func.__interceptor__ = _build_pattern_fn(pattern)
+        func.__interceptor_rule__ = _parse_pattern(pattern)
         return func
     return _decorator
 
@@ -1085,6 +1666,73 @@ def _build_interceptor_chain(last_fn, *interceptors):
         fn = _build_interceptor_fn(f, fn)
     return fn
 
+def _interceptor_applies(func, route):
+    """
+    启动时判断拦截器是否作用于某个路由
+    静态路由的路径是确定的，直接判断；
+    动态路由只知道第一个变量之前的固定前缀和最后一个变量之后的固定后缀，
+    仅凭前缀/后缀无法确定时返回None，由请求时再判断
+    :param func: 拦截器
+    :param route: Route 或者 StaticFileRoute 这类前缀路由
+    :return: True/False/None
+    """
+    kind, s = func.__interceptor_rule__
+    prefix = getattr(route, 'prefix', None)
+    if prefix is not None:
+        head, tail = prefix, None
+    elif route.is_static:
+        return route.path.startswith(s) if kind == 'startswith' else route.path.endswith(s)
+    else:
+        parts = _re_route.split(route.path)
+        head, tail = parts[0], parts[-1]
+    if kind == 'startswith':
+        if head.startswith(s):
+            return True
+        if not s.startswith(head):
+            return False
+        return None
+    if tail is None:
+        return None
+    if tail.endswith(s):
+        return True
+    if not s.endswith(tail):
+        return False
+    return None
+
+def _build_route_interceptor_fn(func, next, always):
+    """
+    与 _build_interceptor_fn 相同，但是next需要传入路由的参数
+    always 为True时不再检测路径
+    :param func:
+    :param next:
+    :param always:
+    :return:
+    """
+    if always:
+        def _wrapper(args):
+            return func(lambda: next(args))
+    else:
+        def _wrapper(args):
+            if func.__interceptor__(ctx.request.path_info):
+                return func(lambda: next(args))
+            return next(args)
+    return _wrapper
+
+def _build_route_chain(route, interceptors):
+    """
+    启动时为每个路由生成拦截器链，只包含可能作用于该路由的拦截器，
+    能确定作用的拦截器在请求时不再检测路径
+    :param route:
+    :param interceptors:
+    :return: 接收路由参数的函数
+    """
+    fn = lambda args: route(*args)
+    for f in reversed(interceptors):
+        applies = _interceptor_applies(f, route)
+        if applies is not False:
+            fn = _build_route_interceptor_fn(f, fn, applies)
+    return fn
+
 def _load_module(module_name):
     """
       Load module from name as str.
@@ -1099,6 +1747,225 @@ def _load_module(module_name):
     m = __import__(from_module, globals(), locals(), [import_module])
     return getattr(m, import_module)
 
+#################################################################
+# 条件请求
+# 响应带上 ETag / Last-Modified，客户端再次请求时带上 If-None-Match / If-Modified-Since，
+# 内容没有变化时返回 304 Not Modified，不发送响应体
+#################################################################
+
+_RE_ETAG_ENCODING = re.compile(r'-(gzip|deflate)"$')
+
+def _etag_base(etag):
+    """
+    去掉弱校验前缀 W/ 和压缩后添加的后缀，用于比较
+        'W/"abc"'    => '"abc"'
+        '"abc-gzip"' => '"abc"'
+    :param etag:
+    :return:
+    """
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    return _RE_ETAG_ENCODING.sub('"', etag)
+
+def _raise_if_not_modified(response, environ, etag=None, last_modified=None):
+    """
+    比较请求的校验值，没有变化时抛出 304
+    有 If-None-Match 时忽略 If-Modified-Since
+    :param response:
+    :param environ:
+    :param etag:
+    :param last_modified: 时间戳
+    :return:
+    """
+    if environ.get('REQUEST_METHOD') not in ('GET', 'HEAD'):
+        return
+    if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        if not etag:
+            return
+        if if_none_match.strip() == '*':
+            raise HttpError.notmodified()
+        base = _etag_base(etag)
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if _etag_base(tag) == base:
+                # 返回客户端缓存的那个表示（可能是压缩后的）的ETag
+                response.set_header('ETag', tag)
+                raise HttpError.notmodified()
+        return
+    if_modified_since = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified is not None:
+        t = parsedate_tz(if_modified_since)
+        if t and int(last_modified) <= mktime_tz(t):
+            raise HttpError.notmodified()
+
+def check_not_modified(etag=None, last_modified=None):
+    """
+    由处理函数提供廉价的校验值，在生成响应之前调用：
+    设置 ETag / Last-Modified，请求的校验值匹配时抛出 304，不再生成响应体
+        @get('/download/:name')
+        def download(name):
+            path = os.path.join(DOWNLOAD_DIR, name)
+            check_not_modified(last_modified=os.path.getmtime(path))
+            ...
+    StaticFileRoute 用文件的ETag 和 mtime 调用它
+    校验值必须随内容的每一次修改而变化，比如 max(created_at) 不能作为博客列表的校验值，修改博客不会改变它
+    :param etag: 字符串，没有引号时自动加上
+    :param last_modified: 时间戳
+    :return:
+    """
+    response = ctx.response
+    if etag:
+        if not etag.startswith('"') and not etag.startswith('W/"'):
+            etag = '"%s"' % etag
+        response.set_header('ETag', etag)
+    if last_modified is not None:
+        response.set_header('Last-Modified', formatdate(last_modified, usegmt=True))
+    _raise_if_not_modified(response, ctx.request._environ, etag, last_modified)
+
+def _not_modified_headers(headers):
+    """
+    304 响应不包含响应体，去掉描述响应体的header
+    :param headers:
+    :return:
+    """
+    return [(k, v) for k, v in headers if k not in ('Content-Type', 'Content-Length', 'Content-Encoding')]
+
+#################################################################
+# 响应压缩
+# 根据请求的 Accept-Encoding 对响应体做 gzip 或 deflate 压缩
+# 太小的响应、已经压缩过的类型（图片、压缩包等）不压缩
+#################################################################
+
+_INCOMPRESSIBLE_TYPES = ('image/', 'video/', 'audio/', 'font/woff',
+                         'application/zip', 'application/gzip', 'application/x-gzip',
+                         'application/x-bzip2', 'application/x-rar-compressed',
+                         'application/octet-stream', 'application/pdf')
+
+def _accept_encoding(accept_encoding):
+    """
+    从Accept-Encoding 中选择压缩方式，优先gzip，q=0 表示不接受
+    明确列出的编码优先于 *，'gzip;q=0, *' 不会选择gzip
+        'gzip, deflate'     => 'gzip'
+        'gzip;q=0, deflate' => 'deflate'
+        'gzip;q=0, *'       => 'deflate'
+        'identity'          => None
+    :param accept_encoding:
+    :return:
+    """
+    qvalues = {}
+    for item in accept_encoding.lower().split(','):
+        parts = item.split(';')
+        coding = parts[0].strip()
+        q = 1.0
+        for param in parts[1:]:
+            k, _, v = param.strip().partition('=')
+            if k.strip() == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding] = q
+    wildcard = qvalues.get('*', 0.0)
+    for encoding in ('gzip', 'deflate'):
+        if qvalues.get(encoding, wildcard) > 0:
+            return encoding
+    return None
+
+def _compressobj(encoding, level):
+    """
+    gzip 使用gzip格式，deflate 按HTTP规范使用zlib格式
+    :param encoding:
+    :param level:
+    :return:
+    """
+    wbits = zlib.MAX_WBITS | 16 if encoding == 'gzip' else zlib.MAX_WBITS
+    return zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+def _compress_generator(body, compressor):
+    """
+    流式压缩，每一块都flush出去，不会因为压缩而延迟发送
+    :param body:
+    :param compressor:
+    :return:
+    """
+    try:
+        for block in body:
+            if block:
+                data = compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                if data:
+                    yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+def _set_encoding(response, encoding):
+    """
+    设置 Content-Encoding，强校验的ETag 需要区分压缩前后的表示，加上压缩方式的后缀
+    :param response:
+    :param encoding:
+    :return:
+    """
+    response.set_header('Content-Encoding', encoding)
+    etag = response.header('ETag')
+    if etag and etag.endswith('"') and not etag.startswith('W/'):
+        response.set_header('ETag', '%s-%s"' % (etag[:-1], encoding))
+
+def _compressible(response):
+    """
+    响应的 Content-Type 是否需要压缩
+    :param response:
+    :return:
+    """
+    content_type = (response.content_type or '').lower()
+    return not content_type.startswith(_INCOMPRESSIBLE_TYPES)
+
+def _add_vary(response):
+    """
+    在 Vary 中加上 Accept-Encoding，告诉缓存服务器响应内容与 Accept-Encoding 有关
+    :param response:
+    :return:
+    """
+    vary = response.header('Vary')
+    if not vary:
+        response.set_header('Vary', 'Accept-Encoding')
+    elif 'accept-encoding' not in vary.lower():
+        response.set_header('Vary', '%s, Accept-Encoding' % vary)
+
+def _compress_response(response, body, accept_encoding, level=6, min_size=1024):
+    """
+    压缩响应体，返回新的响应体，同时设置 Content-Encoding、Content-Length、Vary
+    :param response:
+    :param body: str 或者 str 的可迭代对象
+    :param accept_encoding:
+    :param level: 压缩级别 1-9
+    :param min_size: 小于这个字节数的响应不压缩
+    :return:
+    """
+    if response.header('Content-Encoding') or not _compressible(response):
+        return body
+    _add_vary(response)
+    encoding = _accept_encoding(accept_encoding)
+    if encoding is None:
+        return body
+    if isinstance(body, list):
+        body = ''.join(body)
+    if isinstance(body, str):
+        if len(body) < min_size:
+            return body
+        compressor = _compressobj(encoding, level)
+        body = compressor.compress(body) + compressor.flush()
+        _set_encoding(response, encoding)
+        response.content_length = len(body)
+        return body
+    length = response.content_length
+    if length is not None and int(length) < min_size:
+        return body
+    response.unset_header('Content-Length')
+    _set_encoding(response, encoding)
+    return _compress_generator(body, _compressobj(encoding, level))
+
 #################################################################
 # 全局WSGIApplication的类，实现WSGI接口
 # WSGIApplication 封装了 wsgi Server（run方法） 和 wsgi 处理函数（wsgi静态方法）
@@ -1111,18 +1978,33 @@ class WSGIApplication(object):
     """
     WSBIApplication 应用接口
     """
-    def __init__(self, document_root=None, **kw):
+    def __init__(self, document_root=None, identity_map=False, compress=None, static=None, **kw):
+        """
+        :param document_root:
+        :param identity_map: 为True时每个请求启用orm的一级缓存，见 orm.identity_map
+        :param compress: 响应压缩的配置 dict(enabled=True, level=6, min_size=1024)，为None时不压缩
+        :param static: 非debug模式下的静态文件配置
+                       dict(enabled=True, check_interval=10, cache_bytes=16777216, cache_file_size=65536)，
+                       为None时只在debug模式下提供静态文件
+        :param kw:
+        :return:
+        """
         self._running = False
         self._document_root = document_root
+        self._identity_map = identity_map
+        self._compress = None
+        if compress and compress.get('enabled', True):
+            self._compress = dict(level=compress.get('level', 6), min_size=compress.get('min_size', 1024))
+        self._static = None
+        if static and static.get('enabled', True):
+            self._static = dict(check_interval=static.get('check_interval', 10),
+                                cache_bytes=static.get('cache_bytes', 0),
+                                cache_file_size=static.get('cache_file_size', 65536))
 
         self._interceptors = []
         self._template_engine = None
 
-        self._get_static = {}
-        self._post_static = {}
-
-        self._get_dynamic = []
-        self._post_dynamic = []
+        self._routes = []
 
     def _check_not_running(self):
         """
@@ -1171,16 +2053,7 @@ class WSGIApplication(object):
         """
         self._check_not_running()
         route = Route(func)
-        if route.is_static:
-            if route.method == 'GET':
-                self._get_static[route.path] = route
-            if route.method == 'POST':
-                self._post_static[route.path] = route
-        else:
-            if route.method == 'GET':
-                self._get_dynamic.append(route)
-            if route.method == 'POST':
-                self._post_dynamic.append(route)
+        self._routes.append(route)
         logging.info('Add route: %s' % str(route))
 
     def add_interceptor(self, func):
@@ -1193,17 +2066,29 @@ class WSGIApplication(object):
         self._interceptors.append(func)
         logging.info('Add interceptor: %s' % str(func))
 
-    def run(self, port=9000, host='127.0.0.1'):
+    def run(self, port=9000, host='127.0.0.1', server='wsgiref', debug=True, **kw):
         """
-        启动python自带的WSGI Server
+        启动WSGI Server
         :param port:
         :param host:
+        :param server: 'wsgiref' 使用python自带的单线程Server，只适合开发调试；
+                       'threaded' 使用 transwarp.server 的线程池 + pre-fork Server
+        :param debug:
+        :param kw: 传给 transwarp.server.HTTPServer 的参数：threads、processes、backlog、keepalive_timeout、initializer
+                   使用 wsgiref 时只使用 initializer，在启动前调用 initializer(None)
         :return:
         """
-        from wsgiref.simple_server import make_server
         logging.info('application (%s) will start at %s:%s...' % (self._document_root, host, port))
-        server = make_server(host, port, self.get_wsgi_application(debug=True))
-        server.serve_forever()
+        if server == 'wsgiref':
+            from wsgiref.simple_server import make_server
+            if kw.get('initializer') is not None:
+                kw['initializer'](None)
+            make_server(host, port, self.get_wsgi_application(debug=debug)).serve_forever()
+            return
+        if server != 'threaded':
+            raise ValueError('Invalid server: %s' % server)
+        from server import HTTPServer
+        HTTPServer(self.get_wsgi_application(debug=debug), host, port, **kw).serve_forever()
 
     def get_wsgi_application(self, debug=False):
         """
@@ -1212,37 +2097,35 @@ class WSGIApplication(object):
         :return:
         """
         self._check_not_running()
+        router = _Router()
+        for route in self._routes:
+            router.add(route)
         if debug:
-            self._get_dynamic.append(StaticFileRoute())
+            router.add(StaticFileRoute(self._document_root))
+        elif self._static:
+            router.add(StaticFileRoute(self._document_root, **self._static))
         self._running = True
 
-        _application = Dict(document_root=self._document_root)
-
-        def fn_route():
-            request_method = ctx.request.request_method
-            path_info = ctx.request.path_info
-            if request_method=='GET':
-                fn = self._get_static.get(path_info, None)
-                if fn:
-                    return fn()
-                for fn in self._get_dynamic:
-                    args = fn.match(path_info)
-                    if args:
-                        return fn(*args)
-                raise HttpError.notfound()
-            if request_method=='POST':
-                fn = self._post_static.get(path_info, None)
-                if fn:
-                    return fn()
-                for fn in self._post_dynamic:
-                    args = fn.match(path_info)
-                    if args:
-                        return fn(*args)
+        _application = Dict(document_root=self._document_root, template_engine=self._template_engine, compress=self._compress)
+
+        def fn_notfound():
+            if router.has_method(ctx.request.request_method):
                 raise HttpError.notfound()
             raise HttpError.badrequest()
 
+        # 每个路由预先生成自己的拦截器链，没有匹配的路由时使用完整的拦截器链
+        chains = dict((route, _build_route_chain(route, self._interceptors)) for route in router.routes())
+        fn_fallback = _build_interceptor_chain(fn_notfound, *self._interceptors)
 
-        fn_exec = _build_interceptor_chain(fn_route, *self._interceptors)
+        def fn_exec():
+            r = router.match(ctx.request.request_method, ctx.request.path_info)
+            if r is None:
+                return fn_fallback()
+            route, args = r
+            return chains[route](args)
+
+        use_identity_map = self._identity_map
+        compress = self._compress
 
         def wsgi(env, start_response):
             """
@@ -1251,6 +2134,8 @@ class WSGIApplication(object):
             ctx.application = _application
             ctx.request = Request(env)
             response = ctx.response = Response()
+            if use_identity_map:
+                orm.identity_map.begin()
             try:
                 r = fn_exec()
                 if isinstance(r, Template):
@@ -1259,6 +2144,21 @@ class WSGIApplication(object):
                     r = r.encode('utf-8')
                 if r is None:
                     r = []
+                if isinstance(r, str) and response.status_code == 200 and env['REQUEST_METHOD'] in ('GET', 'HEAD'):
+                    etag = response.header('ETag')
+                    if etag is None:
+                        etag = '"%s"' % hashlib.md5(r).hexdigest()
+                        response.set_header('ETag', etag)
+                    _raise_if_not_modified(response, env, etag)
+                if compress and response.status_code == 200:
+                    # HEAD 也要协商压缩，响应头（Content-Encoding、Content-Length、Vary）必须与GET一致，只是不发送响应体
+                    r = _compress_response(response, r, env.get('HTTP_ACCEPT_ENCODING', ''), **compress)
+                if env['REQUEST_METHOD'] == 'HEAD':
+                    if isinstance(r, str):
+                        response.content_length = len(r)
+                    elif hasattr(r, 'close'):
+                        r.close()
+                    r = []
                 start_response(response.status, response.headers)
                 return r
             except _RedirectError, e:
@@ -1266,6 +2166,12 @@ class WSGIApplication(object):
                 start_response(e.status, response.headers)
                 return []
             except _HttpError, e:
+                if e.status[:3] == '304':
+                    # 304 要带上与200相同的 Vary，否则缓存服务器会把不同编码的响应当成同一个
+                    if compress and _compressible(response):
+                        _add_vary(response)
+                    start_response(e.status, _not_modified_headers(response.headers))
+                    return []
                 start_response(e.status, response.headers)
                 return ['<html><body><h1>', e.status, '</h1></body></html>']
             except Exception, e:
@@ -1284,6 +2190,8 @@ class WSGIApplication(object):
                     stacks.replace('<', '&lt;').replace('>', '&gt;'),
                     '</pre></div></body></html>']
             finally:
+                if use_identity_map:
+                    orm.identity_map.clear()
                 del ctx.application
                 del ctx.request
                 del ctx.response
@@ -5,12 +5,12 @@ __author__ = 'Luxury'
 
 import os, re, time, base64, hashlib, logging
 
-import markdown2
-
-from transwarp.web import get, post, ctx, view, interceptor, HttpError
+from transwarp.web import get, post, ctx, view, interceptor, cached_view, HttpError
 
 from apis import api, Page, APIError, APIValueError, APIPermissionError, APIResourceNotFoundError
 from models import User, Blog, Comment
+from render import blog_html
+import sessions
 from config import configs
 
 _COOKIE_NAME = 'awesession'
@@ -38,11 +38,15 @@ def parse_signed_cookie(cookie_str):
         id, expires, md5 = L
         if int(expires) < time.time():
             return None
+        fields, gens = sessions.lookup(id, cookie_str)
+        if fields is not None:
+            return User(**fields)
         user = User.get(id)
         if user is None:
             return None
         if md5 != hashlib.md5('%s-%s-%s-%s' % (id, user.password, expires, _COOKIE_KEY)).hexdigest():
             return None
+        sessions.set_user(id, cookie_str, user, int(expires), gens)
         return user
     except:
         return None
@@ -55,6 +59,8 @@ def check_admin():
 
 @interceptor('/')
 def user_interceptor(next):
+    if ctx.request.path_info.startswith('/static/'):
+        return next()
     logging.info('try to bind user from session cookie...')
     user = None
     cookie = ctx.request.cookies.get(_COOKIE_NAME)
@@ -73,20 +79,24 @@ def manage_interceptor(next):
         return next()
     raise HttpError.seeother('/signin')
 
+@cached_view(ttl=60, tags=('blogs',), cookie=_COOKIE_NAME)
 @view('blogs.html')
 @get('/')
 def index():
-    blogs, page = _get_blogs_by_page()
+    # 首页只显示摘要，不查询正文
+    blogs, page = _get_blogs_by_page(defer=('content',))
     return dict(page=page, blogs=blogs, user=ctx.request.user)
 
+@cached_view(ttl=60, tags=lambda blog_id: ('blog:%s' % blog_id,), cookie=_COOKIE_NAME)
 @view('blog.html')
 @get('/blog/:blog_id')
 def blog(blog_id):
     blog = Blog.get(blog_id)
     if blog is None:
         raise HttpError.notfound()
-    blog.html_content = markdown2.markdown(blog.content)
-    comments = Comment.find_by('where blog_id=? order by created_at desc limit 1000', blog_id)
+    blog.html_content = blog_html(blog)
+    # 评论列表在模板的 {% cache %} 片段中使用，只在片段未命中时才查询
+    comments = lambda: Comment.find_by('where blog_id=? order by created_at desc limit 1000', blog_id)
     return dict(blog=blog, comments=comments, user=ctx.request.user)
 
 @view('signin.html')
@@ -96,6 +106,9 @@ def signin():
 
 @get('/signout')
 def signout():
+    user = ctx.request.user
+    if user:
+        sessions.invalidate(user.id, ctx.request.cookies.get(_COOKIE_NAME))
     ctx.response.delete_cookie(_COOKIE_NAME)
     raise HttpError.seeother('/')
 
@@ -149,11 +162,10 @@ def register_user():
 def register():
     return dict()
 
-def _get_blogs_by_page():
+def _get_blogs_by_page(defer=None):
     total = Blog.count_all()
-    total= total[0].values()[0]
     page = Page(total, _get_page_index())
-    blogs = Blog.find_by('order by created_at desc limit ?,?', page.offset, page.limit)
+    blogs = Blog.find_by('order by created_at desc limit ?,?', page.offset, page.limit, defer=defer)
     return blogs, page
 
 @get('/manage/')
@@ -195,7 +207,7 @@ def api_get_blogs():
     blogs, page = _get_blogs_by_page()
     if format=='html':
         for blog in blogs:
-            blog.content = markdown2.markdown(blog.content)
+            blog.content = blog_html(blog)
     return dict(blogs=blogs, page=page)
 
 @api
@@ -284,20 +296,22 @@ def api_delete_comment(comment_id):
     comment.delete()
     return dict(id=comment_id)
 
-@api
+@api(stream=True)
 @get('/api/comments')
 def api_get_comments():
     total = Comment.count_all()
     page = Page(total, _get_page_index())
-    comments = Comment.find_by('order by created_at desc limit ?,?', page.offset, page.limit)
+    comments = Comment.iter_by('order by created_at desc limit ?,?', page.offset, page.limit)
     return dict(comments=comments, page=page)
 
-@api
+def _hide_password(user):
+    user.password = '******'
+    return user
+
+@api(stream=True)
 @get('/api/users')
 def api_get_users():
     total = User.count_all()
     page = Page(total, _get_page_index())
-    users = User.find_by('order by created_at desc limit ?,?', page.offset, page.limit)
-    for u in users:
-        u.password = '******'
-    return dict(users=users, page=page)
\ No newline at end of file
+    users = User.iter_by('order by created_at desc limit ?,?', page.offset, page.limit)
+    return dict(users=(_hide_password(u) for u in users), page=page)
\ No newline at end of file
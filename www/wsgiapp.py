@@ -12,10 +12,12 @@ import logging; logging.basicConfig(level=logging.INFO)
 import os, time
 from datetime import datetime
 
-from transwarp import db
-from transwarp.web import WSGIApplication, Jinja2TemplateEngine
+from transwarp import db, orm, cache
+from transwarp.web import WSGIApplication, Jinja2TemplateEngine, set_page_cache, set_fragment_cache
 
 from config import configs
+import render
+import sessions
 
 def datetime_filter(t):
     delta = int(time.time() - t)
@@ -33,11 +35,33 @@ def datetime_filter(t):
 # init db:
 db.create_engine(**configs.db)
 
+# init markdown render, the process pool is started by init_process():
+render.configure(**configs.render)
+
+# init cache:
+if configs.cache.backend == 'memcache':
+    orm.set_cache(cache.MemcacheCache(configs.cache.servers, name='orm.rows'))
+    set_page_cache(cache.MemcacheCache(configs.cache.servers, name='web.pages'),
+                   tags=cache.MemcacheCache(configs.cache.servers, name='web.page_tags'))
+    set_fragment_cache(cache.FragmentCache(shared=cache.MemcacheCache(configs.cache.servers), name='web.fragments'))
+    sessions.set_cache(cache.FragmentCache(shared=cache.MemcacheCache(configs.cache.servers), ttl=600, name='sessions'))
+elif configs.server.processes > 1:
+    # invalidation must reach every process, a per-process cache can't do that:
+    logging.warning('row, page, fragment and session caches disabled: pre-fork workers need the memcache backend.')
+    orm.set_cache(None)
+    set_page_cache(None)
+    set_fragment_cache(None)
+    sessions.set_cache(None)
+
 # init wsgi app:
-wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)))
+wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)), identity_map=True, compress=configs.compress, static=configs.static)
 
-template_engine = Jinja2TemplateEngine(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'))
+template_engine = Jinja2TemplateEngine(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates'),
+                                       bytecode_cache_dir=configs.template.bytecode_cache or None,
+                                       auto_reload=configs.server.debug)
 template_engine.add_filter('datetime', datetime_filter)
+if configs.template.precompile:
+    template_engine.precompile()
 
 wsgi.template_engine = template_engine
 
@@ -47,7 +71,14 @@ wsgi.add_interceptor(urls.user_interceptor)
 wsgi.add_interceptor(urls.manage_interceptor)
 wsgi.add_module(urls)
 
+def init_process(server):
+    # called in every serving process before worker threads start and
+    # before any db connection is opened, so the render pool forks a clean process:
+    render.start(close_fds=(server.fileno(),) if server else ())
+
 if __name__ == '__main__':
-    wsgi.run(9000, host='0.0.0.0')
+    wsgi.run(9000, host='0.0.0.0', initializer=init_process, **configs.server)
 else:
+    # external WSGI servers should call init_process(None) in each worker after fork,
+    # otherwise markdown is rendered in the request thread:
     application = wsgi.get_wsgi_application()
\ No newline at end of file